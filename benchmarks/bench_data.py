@@ -0,0 +1,166 @@
+'''
+Throughput benchmark of the training data pipeline, DataLoadPreprocess behind Loader, over a synthetic dataset
+written to disk with the layout of data.json, nyu_<mode>, nyu_depth_<mode> and bbox_embed at the source
+resolution of 640x480, for a range of num_threads values. An existing dataset can be given with --data_path, and
+--set shard_path=... or --set embed_store=... benchmarks the packed formats. Before timing, shards packed from a small
+synthetic dataset are packed again in place with other content to check that the online_eval cache moves to another
+sub-directory.
+
+    python benchmarks/bench_data.py --num_threads 0,1,2,4 --samples 64 --output data.json
+'''
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_args, parse_list, write_report  # noqa: E402
+
+
+SOURCE_HEIGHT = 480
+SOURCE_WIDTH = 640
+
+
+def make_synthetic_dataset(root, samples, num_objects, emb_size, seed=0):
+    '''
+    Description: Writes random images, depths and detections readable by DataLoadPreprocess in both splits
+    '''
+    rng = np.random.default_rng(seed)
+    index = {}
+    os.makedirs(os.path.join(root, 'bbox_embed'), exist_ok=True)
+
+    for mode, key_offset in (('train', 0), ('test', samples)):
+        os.makedirs(os.path.join(root, 'nyu_' + mode), exist_ok=True)
+        os.makedirs(os.path.join(root, 'nyu_depth_' + mode), exist_ok=True)
+        files, keys = [], []
+
+        for idx in range(samples):
+            name = '{}.jpg'.format(idx + 1)
+            image = rng.integers(0, 256, (SOURCE_HEIGHT, SOURCE_WIDTH, 3), dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(root, 'nyu_' + mode, name), quality=90)
+            # depths are stored transposed, as DataLoadPreprocess expects
+            depth = rng.uniform(0.2, 9.5, (SOURCE_WIDTH, SOURCE_HEIGHT)).astype(np.float32)
+            np.savez_compressed(os.path.join(root, 'nyu_depth_' + mode, '{}.npz'.format(idx + 1)), depth=depth)
+
+            x = rng.integers(0, SOURCE_WIDTH - 32, num_objects)
+            y = rng.integers(0, SOURCE_HEIGHT - 32, num_objects)
+            bbox = np.stack([x, y, x + rng.integers(16, 32, num_objects) + (SOURCE_WIDTH - 32 - x) // 2,
+                             y + rng.integers(16, 32, num_objects) + (SOURCE_HEIGHT - 32 - y) // 2], axis=1)
+            embed = rng.standard_normal((num_objects, emb_size)).astype(np.float32)
+            np.savez_compressed(os.path.join(root, 'bbox_embed', '{}.npz'.format(key_offset + idx)),
+                                bbox=bbox, embed=embed)
+
+            files.append(name)
+            keys.append(key_offset + idx)
+
+        index['idx_to_' + mode + '_files'] = files
+        index['idx_to_' + mode + '_bbox_embed'] = keys
+
+    with open(os.path.join(root, 'data.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def check_cache_fingerprint(args):
+    '''
+    Description: Packs the shards of a synthetic dataset, then rewrites the dataset and packs them again in place,
+                 the SampleCache of online_eval being required to use another sub-directory of eval_cache_dir
+    '''
+    from dataloader import SampleCache, cache_fingerprint
+    from shards import pack_shards
+
+    args = copy.copy(args)
+    root = tempfile.mkdtemp(prefix='rdnet-cache-')
+    try:
+        args.data_path = os.path.join(root, 'data') + '/'
+        args.shard_path = os.path.join(root, 'shards')
+        args.embed_store = ''
+        directories = []
+        for seed in range(2):
+            make_synthetic_dataset(args.data_path, 2, 2, args.emb_size, seed=seed)
+            pack_shards(args, 'online_eval', args.shard_path)
+            fingerprint = cache_fingerprint(args, 'online_eval')
+            if fingerprint['shard_index'] is None:
+                raise AssertionError('the index of the online_eval shards is missing from the fingerprint')
+            cache = SampleCache([], cache_dir=os.path.join(root, 'cache'), fingerprint=fingerprint)
+            directories.append(cache.cache_dir)
+        if directories[0] == directories[1]:
+            raise AssertionError('repacked shards reuse the cache sub-directory {}'.format(directories[0]))
+    finally:
+        shutil.rmtree(root)
+
+
+def measure(args, mode, epochs):
+    from dataloader import Loader
+
+    start = time.perf_counter()
+    loader = Loader(args, mode)
+    build_time = time.perf_counter() - start
+
+    first_batch, samples = None, 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in loader.data:
+            if first_batch is None:
+                first_batch = time.perf_counter() - start
+            samples += len(batch['image'])
+    elapsed = time.perf_counter() - start
+
+    return {'samples': samples, 'build_ms': build_time * 1e3, 'first_batch_ms': first_batch * 1e3,
+            'elapsed_s': elapsed, 'samples_per_s': samples / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of the training data pipeline')
+    parser.add_argument('--num_threads', default='0,1,2,4', help='DataLoader workers to sweep')
+    parser.add_argument('--batch_size', type=int, default=None, help='defaults to train_arg.txt')
+    parser.add_argument('--mode', default='train', choices=['train', 'online_eval', 'test'])
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--data_path', default=None, help='existing dataset, a synthetic one is written otherwise')
+    parser.add_argument('--samples', type=int, default=64, help='samples per split of the synthetic dataset')
+    parser.add_argument('--objects', type=int, default=8, help='objects per image of the synthetic dataset')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic dataset')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override of a train_arg.txt value applied to every run')
+    parser.add_argument('--output', default='-', help='JSON report path, - for stdout')
+    opts = parser.parse_args()
+
+    args = load_args(opts.set)
+    check_cache_fingerprint(args)
+    if opts.batch_size is not None:
+        args.batch_size = opts.batch_size
+
+    data_path = opts.data_path
+    if data_path is None:
+        data_path = tempfile.mkdtemp(prefix='rdnet-bench-')
+        print('Writing synthetic dataset to {}'.format(data_path), file=sys.stderr)
+        make_synthetic_dataset(data_path, opts.samples, opts.objects, args.emb_size)
+    args.data_path = data_path
+
+    results = []
+    try:
+        for num_threads in parse_list(opts.num_threads):
+            args.num_threads = num_threads
+            result = measure(args, opts.mode, opts.epochs)
+            result['num_threads'] = num_threads
+            results.append(result)
+            print('num_threads {}: {:.1f} samples/s, first batch {:.0f}ms'.format(
+                num_threads, result['samples_per_s'], result['first_batch_ms']), file=sys.stderr)
+    finally:
+        if opts.data_path is None and not opts.keep:
+            shutil.rmtree(data_path)
+
+    write_report('data', {'mode': opts.mode, 'epochs': opts.epochs, 'batch_size': args.batch_size,
+                          'data_path': opts.data_path, 'samples': opts.samples, 'objects': opts.objects,
+                          'overrides': opts.set}, results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
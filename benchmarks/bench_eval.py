@@ -0,0 +1,109 @@
+'''
+Benchmark of the evaluation metrics: the per-sample numpy loop of compute_errors against the batched
+compute_errors_batched with the exact and the histogram medians. Before timing, masked_median is checked against
+np.median on odd and even numbers of valid pixels, and the batched metrics against compute_errors.
+
+    python benchmarks/bench_eval.py --batch_size 1,8 --repeats 5
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_args, parse_list, summarize, timeit, write_report  # noqa: E402
+
+
+def random_batch(batch_size, height, width, generator):
+    depths = 0.5 + 9 * torch.rand((batch_size, 1, height, width), generator=generator, dtype=torch.float64)
+    preds = depths * (0.8 + 0.4 * torch.rand(depths.shape, generator=generator, dtype=torch.float64))
+    masks = torch.rand(depths.shape, generator=generator) < 0.7
+    return depths, preds, masks
+
+
+def check_median(generator):
+    '''
+    Description: Checks masked_median against np.median on the valid entries of every row, with an odd and an
+                 even count of them and a row without any
+    '''
+    from eval import masked_median
+
+    values = torch.rand((3, 10), generator=generator, dtype=torch.float64)
+    masks = torch.zeros((3, 10), dtype=torch.bool)
+    masks[0, :7] = True
+    masks[1, 2:] = True
+    medians = masked_median(values, masks)
+    for row, (value, mask) in enumerate(zip(values, masks)):
+        if not mask.any():
+            assert torch.isnan(medians[row]), 'row {} without valid entry has median {}'.format(row, medians[row])
+            continue
+        expected = np.median(value[mask].numpy())
+        assert abs(medians[row].item() - expected) < 1e-12, 'row {} of {} entries has median {}, np.median {}'.format(
+            row, int(mask.sum()), medians[row].item(), expected)
+
+
+def check_metrics(generator, height, width):
+    from eval import compute_errors, compute_errors_batched
+
+    depths, preds, masks = random_batch(4, height, width, generator)
+    # one sample with an even count of valid pixels and one with an odd count
+    masks[0].view(-1)[:] = False
+    masks[0].view(-1)[:10] = True
+    masks[1].view(-1)[:] = False
+    masks[1].view(-1)[:11] = True
+    expected = compute_errors(depths.numpy(), preds.numpy(), masks.numpy()) * len(depths)
+    sums, cnt = compute_errors_batched(depths, preds, masks)
+    assert cnt.item() == len(depths)
+    assert np.allclose(sums.numpy(), expected, rtol=1e-5, atol=1e-6), 'batched metrics {} differ from {}'.format(
+        sums.numpy(), expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the evaluation metrics')
+    parser.add_argument('--batch_size', default='1,8', help='comma separated list of batch sizes')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override of a train_arg.txt value applied to every run')
+    parser.add_argument('--output', default='-', help='JSON report path, - for stdout')
+    opts = parser.parse_args()
+
+    from eval import compute_errors, compute_errors_batched, masked_histogram_median
+
+    args = load_args(opts.set)
+    device = torch.device(opts.device)
+    generator = torch.Generator().manual_seed(0)
+    check_median(generator)
+    check_metrics(generator, args.image_height, args.image_width)
+
+    def histogram(values, masks):
+        return masked_histogram_median(values, masks, 1e-3, 80.)
+
+    results = []
+    for batch_size in parse_list(opts.batch_size):
+        depths, preds, masks = (value.float() if value.is_floating_point() else value
+                                for value in random_batch(batch_size, args.image_height, args.image_width, generator))
+        arrays = (depths.numpy(), preds.numpy(), masks.numpy())
+        depths, preds, masks = depths.to(device), preds.to(device), masks.to(device)
+
+        result = {'batch_size': batch_size}
+        result['numpy'] = summarize(timeit(lambda: compute_errors(*arrays), opts.repeats, opts.warmup))
+        result['exact'] = summarize(timeit(lambda: compute_errors_batched(depths, preds, masks), opts.repeats,
+                                           opts.warmup, device))
+        result['histogram'] = summarize(timeit(lambda: compute_errors_batched(depths, preds, masks, histogram),
+                                               opts.repeats, opts.warmup, device))
+        print('batch {}: numpy {:.1f}ms, exact {:.1f}ms, histogram {:.1f}ms'.format(
+            batch_size, result['numpy']['median_ms'], result['exact']['median_ms'],
+            result['histogram']['median_ms']), file=sys.stderr)
+        results.append(result)
+
+    write_report('eval', {'device': opts.device, 'image_size': [args.image_height, args.image_width],
+                          'repeats': opts.repeats, 'warmup': opts.warmup}, results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Micro-benchmark of the per-object patch masks built by KnowledgeFusion: the former Python double loop
+over batch and objects against the batched box_masks, at realistic object counts. Before timing, pixel boxes
+are checked to map to the expected blocks of patches.
+
+    python benchmarks/bench_masks.py --device cpu --objects 10,30,50,100
+'''
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rdnet'))
+
+from model import box_masks, patch_boxes  # noqa: E402
+
+
+def loop_masks(locs, height, width):
+    b, n, _ = locs.shape
+    masks = torch.zeros((b, n, height, width), dtype=torch.bool).to(locs.device)
+
+    for idx, loc in enumerate(locs):
+        for jdx, obj_loc in enumerate(loc):
+            masks[idx, jdx, obj_loc[1]:obj_loc[3],
+                  obj_loc[0]:obj_loc[2]] = True
+
+    return masks
+
+
+def random_locs(batch_size, num_objects, height, width, device):
+    x = torch.randint(0, width, (batch_size, num_objects, 1))
+    y = torch.randint(0, height, (batch_size, num_objects, 1))
+    xmax = x + torch.randint(1, width + 1, (batch_size, num_objects, 1))
+    ymax = y + torch.randint(1, height + 1, (batch_size, num_objects, 1))
+    return torch.cat([x, y, xmax, ymax], dim=2).to(device)
+
+
+def check_pixel_boxes(patch_size=16, height=16, width=24):
+    '''
+    Description: Checks that boxes in pixels of a 256x384 image select the patches they overlap, rows by y and
+                 columns by x
+    '''
+    cases = [
+        # (x, y, xmax, ymax) in pixels, expected (rows, cols) of patches
+        ((100, 50, 200, 150), (slice(3, 10), slice(6, 13))),
+        ((20, 30, 60, 90), (slice(1, 6), slice(1, 4))),
+        ((0, 0, 10, 10), (slice(0, 1), slice(0, 1))),
+        ((32, 48, 32, 48), (slice(3, 4), slice(2, 3))),
+        ((0, 0, width * patch_size, height * patch_size), (slice(0, height), slice(0, width))),
+    ]
+    locs = torch.tensor([[box for box, _ in cases]])
+    masks = box_masks(patch_boxes(locs, patch_size), height, width)[0]
+    for mask, (box, (rows, cols)) in zip(masks, cases):
+        expected = torch.zeros((height, width), dtype=torch.bool)
+        expected[rows, cols] = True
+        assert torch.equal(mask, expected), 'box {} selects the wrong patches'.format(box)
+
+
+def timeit(fn, repeats, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-object patch mask construction')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--objects', default='10,30,50,100')
+    parser.add_argument('--grid', default='16,24', help='patch grid as rows,cols')
+    parser.add_argument('--repeats', type=int, default=20)
+    opts = parser.parse_args()
+
+    check_pixel_boxes()
+    device = torch.device(opts.device)
+    height, width = map(int, opts.grid.split(','))
+
+    print('{:>8} {:>12} {:>12} {:>8}'.format('objects', 'loop (ms)', 'batched (ms)', 'speedup'))
+    for num_objects in map(int, opts.objects.split(',')):
+        locs = random_locs(opts.batch_size, num_objects, height, width, device)
+        assert torch.equal(loop_masks(locs, height, width), box_masks(locs, height, width))
+
+        loop = timeit(lambda: loop_masks(locs, height, width), opts.repeats, device)
+        batched = timeit(lambda: box_masks(locs, height, width), opts.repeats, device)
+        print('{:>8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+            num_objects, loop * 1e3, batched * 1e3, loop / batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Latency and memory benchmark of RDNet built from train_arg.txt on synthetic inputs. Every combination of the swept
+values runs in its own process and reports its forward latency in eval mode, the latency of a training forward and
+of its backward pass, and the peak RSS of the process.
+
+    python benchmarks/bench_model.py --batch_size 1,4 --objects 4,16 --landmarks 32,64 --output model.json
+    python benchmarks/bench_model.py --set knowledge_dims=64,64 --set dense_dims=32,32,32,32 --set latent_dims=32
+'''
+import argparse
+import itertools
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_args, now, parse_list, peak_rss_mb, run_isolated, summarize, timeit, write_report  # noqa: E402
+
+
+def synthetic_batch(args, batch_size, num_objects, device, seed=0):
+    '''
+    Return: Images, embeddings and boxes shaped like a batch of Loader, the boxes being in image_size pixels
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    height, width = args.image_height, args.image_width
+
+    images = torch.randn((batch_size, 3, height, width), generator=generator)
+    embeddings = torch.randn((batch_size, num_objects, args.emb_size), generator=generator)
+    # (x, y, xmax, ymax) with x along the width, as built by Geometry.resize_boxes
+    x = torch.randint(0, width - 1, (batch_size, num_objects, 1), generator=generator)
+    y = torch.randint(0, height - 1, (batch_size, num_objects, 1), generator=generator)
+    xmax = x + 1 + (torch.rand((batch_size, num_objects, 1), generator=generator) * (width - 1 - x)).long()
+    ymax = y + 1 + (torch.rand((batch_size, num_objects, 1), generator=generator) * (height - 1 - y)).long()
+    boxes = torch.cat([x, y, xmax, ymax], dim=2)
+
+    return images.to(device), embeddings.to(device), boxes.to(device)
+
+
+def measure(overrides, batch_size, num_objects, repeats, warmup, device, threads):
+    from model import build_model
+
+    if threads:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    args = load_args(overrides)
+    model = build_model(args).to(device)
+    images, embeddings, boxes = synthetic_batch(args, batch_size, num_objects, device)
+
+    def forward():
+        return model(images, embeddings, boxes)
+
+    model.eval()
+    with torch.no_grad():
+        forward_times = timeit(forward, repeats, warmup, device)
+
+    model.train()
+    train_forward_times, backward_times = [], []
+    for idx in range(warmup + repeats):
+        start = now(device)
+        loss = forward().mean()
+        middle = now(device)
+        loss.backward()
+        end = now(device)
+        model.zero_grad(set_to_none=True)
+        if idx >= warmup:
+            train_forward_times.append((middle - start) * 1e3)
+            backward_times.append((end - middle) * 1e3)
+
+    result = {
+        'params': sum(p.numel() for p in model.parameters()),
+        'forward': summarize(forward_times),
+        'train_forward': summarize(train_forward_times),
+        'backward': summarize(backward_times),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if torch.device(device).type == 'cuda':
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark RDNet forward and backward latency and memory')
+    parser.add_argument('--batch_size', default='1,4')
+    parser.add_argument('--objects', default='4,16', help='number of objects per image')
+    parser.add_argument('--patch_size', default=None, help='defaults to train_arg.txt')
+    parser.add_argument('--landmarks', default=None, help='defaults to train_arg.txt')
+    parser.add_argument('--image_size', default=None, help='comma separated list of HEIGHTxWIDTH')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override of a train_arg.txt value applied to every run')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--no_isolate', action='store_true', help='run every configuration in this process')
+    parser.add_argument('--output', default='-', help='JSON report path, - for stdout')
+    opts = parser.parse_args()
+
+    args = load_args(opts.set)
+    patch_sizes = parse_list(opts.patch_size) if opts.patch_size else [args.patch_size]
+    landmarks = parse_list(opts.landmarks) if opts.landmarks else [args.landmarks]
+    image_sizes = ([tuple(map(int, size.split('x'))) for size in opts.image_size.split(',')]
+                   if opts.image_size else [(args.image_height, args.image_width)])
+
+    results = []
+    sweep = itertools.product(parse_list(opts.batch_size), parse_list(opts.objects), patch_sizes, landmarks, image_sizes)
+    for batch_size, num_objects, patch_size, landmark, (height, width) in sweep:
+        config = {'batch_size': batch_size, 'objects': num_objects, 'patch_size': patch_size,
+                  'landmarks': landmark, 'image_height': height, 'image_width': width}
+        overrides = opts.set + ['patch_size={}'.format(patch_size), 'landmarks={}'.format(landmark),
+                                'image_height={}'.format(height), 'image_width={}'.format(width)]
+        run = measure if opts.no_isolate else lambda *values: run_isolated(measure, *values)
+        result = run(overrides, batch_size, num_objects, opts.repeats, opts.warmup, opts.device, opts.threads)
+
+        if 'error' in result:
+            print('{} failed: {}'.format(config, result['error']), file=sys.stderr)
+        else:
+            print('batch {batch_size} objects {objects} patch {patch_size} landmarks {landmarks} '
+                  '{image_height}x{image_width}: forward {fwd:.1f}ms, train forward {tfwd:.1f}ms, '
+                  'backward {bwd:.1f}ms, peak rss {peak_rss_mb:.0f}MB'.format(
+                      fwd=result['forward']['median_ms'], tfwd=result['train_forward']['median_ms'],
+                      bwd=result['backward']['median_ms'], peak_rss_mb=result['peak_rss_mb'], **config),
+                  file=sys.stderr)
+        config.update(result)
+        results.append(config)
+
+    write_report('model', {'overrides': opts.set, 'repeats': opts.repeats, 'warmup': opts.warmup,
+                           'device': opts.device}, results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
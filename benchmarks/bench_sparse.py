@@ -0,0 +1,189 @@
+'''
+Check and benchmark of the sparse per-object path of KnowledgeFusion and of the masked attention of
+InjectionBlock. Boxes in pixels of image_size are drawn at several sizes. For every size, an image without padded
+objects is checked to give the same output batched with a padded one as alone, the masked attention is checked
+against running the transformer on the tokens inside each box alone, and the sparse path is checked
+in float64 against the dense path with mask_attention, outputs and gradients. The training step of KnowledgeFusion
+is then timed on the dense path, the dense path with mask_attention and the sparse path.
+
+    python benchmarks/bench_sparse.py --objects 30 --box 32x16,96x48,192x96
+'''
+import argparse
+import os
+import sys
+
+import torch
+from einops import rearrange
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_args, parse_list, summarize, timeit, write_report  # noqa: E402
+
+
+def pixel_boxes(args, batch_size, num_objects, box_width, box_height, generator):
+    '''
+    Return: Boxes with shape BxNx4 of box_width x box_height pixels at random positions in image_size
+    '''
+    x = torch.randint(0, args.image_width - box_width + 1, (batch_size, num_objects, 1), generator=generator)
+    y = torch.randint(0, args.image_height - box_height + 1, (batch_size, num_objects, 1), generator=generator)
+    return torch.cat([x, y, x + box_width, y + box_height], dim=2)
+
+
+def build_knowledge(args, **overrides):
+    from model import build_model
+
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    torch.manual_seed(0)
+    return build_model(args).knowledge
+
+
+def knowledge_inputs(args, batch_size, num_objects, box, generator, dtype=torch.float32):
+    grid = (args.image_height // args.patch_size, args.image_width // args.patch_size)
+    # the patch dimension of the first InjectionBlock, which KnowledgeFusion receives from the patch embedding
+    patch_dim = 3 * args.patch_size ** 2
+    patches = torch.randn((batch_size,) + grid + (patch_dim,), generator=generator, dtype=dtype)
+    embs = torch.randn((batch_size, num_objects, args.emb_size), generator=generator, dtype=dtype)
+    boxes = pixel_boxes(args, batch_size, num_objects, *box, generator)
+    objects = torch.ones((batch_size, num_objects), dtype=torch.bool)
+    # the last images are padded as by pad_collate
+    objects[1:, num_objects // 2:] = False
+    return patches, embs, boxes, objects
+
+
+def check_attend(args, batch_size, num_objects, box, transformer):
+    '''
+    Return: Largest difference between InjectionBlock.attend on the masks of pixel boxes and the transformer run on
+            the tokens inside each box alone, tokens outside of the boxes being required to pass through unchanged
+    '''
+    from blocks import InjectionBlock
+    from model import box_masks, patch_boxes
+
+    generator = torch.Generator().manual_seed(3)
+    height, width = args.image_height // args.patch_size, args.image_width // args.patch_size
+    boxes = pixel_boxes(args, batch_size, num_objects, *box, generator)
+    masks = rearrange(box_masks(patch_boxes(boxes, args.patch_size), height, width), 'b n h w -> (b n) (h w)')
+    # the cls token heading every sequence is always attended
+    masks = torch.cat([torch.ones_like(masks[:, :1]), masks], dim=1)
+
+    dim = args.knowledge_dims[0]
+    torch.manual_seed(0)
+    block = InjectionBlock(emb_size=args.emb_size, inp_dim=dim, out_dim=dim, max_patches=height * width,
+                           use_readout=args.use_readout, transformer=transformer, landmarks=args.landmarks,
+                           mask_attention=True).eval()
+    y = torch.randn((len(masks), masks.shape[1], dim), generator=generator)
+
+    diff = 0.0
+    with torch.no_grad():
+        out = block.attend(y, masks)
+        for idx, mask in enumerate(masks):
+            if not torch.equal(out[idx, ~mask], y[idx, ~mask]):
+                raise AssertionError('attend changed tokens outside of box {}'.format(idx))
+            reference = block.transformer(y[idx:idx + 1, mask])[0]
+            diff = max(diff, (out[idx, mask] - reference).abs().max().item())
+    return diff
+
+
+def check_padding(args, num_objects, box):
+    '''
+    Return: Largest difference, for the transformer of train_arg.txt on every path, between the
+            output of an image without padding batched with a padded one and its output alone with objects None
+    '''
+    generator = torch.Generator().manual_seed(4)
+    patches, embs, boxes, objects = knowledge_inputs(args, 2, num_objects, box, generator)
+    diff = 0.0
+    for sparse_objects, mask_attention in ((False, False), (False, True), (True, True)):
+        knowledge = build_knowledge(args, sparse_objects=sparse_objects, mask_attention=mask_attention).eval()
+        with torch.no_grad():
+            batched = knowledge(patches, embs, boxes, objects)[0]
+            alone = knowledge(patches[:1], embs[:1], boxes[:1])[0]
+        diff = max(diff, (batched - alone).abs().max().item())
+    return diff
+
+
+def check(args, batch_size, num_objects, box):
+    '''
+    Return: Largest differences of the outputs and of the gradients between the sparse path and the dense path
+            with mask_attention, computed in float64
+    '''
+    generator = torch.Generator().manual_seed(1)
+    inputs = knowledge_inputs(args, batch_size, num_objects, box, generator, torch.float64)
+    dense = build_knowledge(args, sparse_objects=False, mask_attention=True).double()
+    sparse = build_knowledge(args, sparse_objects=True, mask_attention=True).double()
+
+    dense_out, sparse_out = dense(*inputs), sparse(*inputs)
+    dense_out.sum().backward()
+    sparse_out.sum().backward()
+    grad = max((a.grad - b.grad).abs().max().item() for a, b in zip(dense.parameters(), sparse.parameters())
+               if a.grad is not None)
+    return {'output_diff': (dense_out - sparse_out).abs().max().item(), 'grad_diff': grad}
+
+
+def measure(args, batch_size, num_objects, box, repeats, warmup, **overrides):
+    generator = torch.Generator().manual_seed(2)
+    inputs = knowledge_inputs(args, batch_size, num_objects, box, generator)
+    knowledge = build_knowledge(args, **overrides).train()
+
+    def step():
+        knowledge(*inputs).mean().backward()
+        knowledge.zero_grad(set_to_none=True)
+
+    return summarize(timeit(step, repeats, warmup))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the sparse per-object path of KnowledgeFusion')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--objects', type=int, default=30, help='number of objects per image')
+    parser.add_argument('--box', default='32x16,96x48,192x96', help='comma separated list of WIDTHxHEIGHT pixels')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override of a train_arg.txt value applied to every run')
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--tolerance', type=float, default=1e-9, help='largest float64 difference accepted')
+    parser.add_argument('--output', default='-', help='JSON report path, - for stdout')
+    opts = parser.parse_args()
+
+    from blocks import Nystromer, Transformer
+
+    args = load_args(opts.set)
+    boxes = [tuple(parse_list(size.replace('x', ','))) for size in opts.box.split(',')]
+
+    results = []
+    for box in boxes:
+        result = {'box': list(box)}
+        # Nystromer approximates the attention with landmarks, which differ between a box alone and a box packed
+        # with the padding of the longest one, only the plain transformer is expected to match exactly
+        result['attend_diff'] = check_attend(args, opts.batch_size, opts.objects, box, Transformer)
+        result['attend_diff_nystrom'] = check_attend(args, opts.batch_size, opts.objects, box, Nystromer)
+        result['padding_diff'] = check_padding(args, opts.objects, box)
+        result.update(check(args, opts.batch_size, opts.objects, box))
+        if result['padding_diff'] > 1e-5:
+            raise AssertionError('padding the batch changes the output of an unpadded image for {}x{} boxes: {}'.format(
+                box[0], box[1], result['padding_diff']))
+        if result['attend_diff'] > 1e-5:
+            raise AssertionError('masked attention differs from the per-box transformer for {}x{} boxes: {}'.format(
+                box[0], box[1], result['attend_diff']))
+        if max(result['output_diff'], result['grad_diff']) > opts.tolerance:
+            raise AssertionError('sparse path differs from the dense path for {}x{} boxes: {}'.format(
+                box[0], box[1], result))
+
+        result['dense'] = measure(args, opts.batch_size, opts.objects, box, opts.repeats, opts.warmup,
+                                  sparse_objects=False, mask_attention=False)
+        result['masked'] = measure(args, opts.batch_size, opts.objects, box, opts.repeats, opts.warmup,
+                                   sparse_objects=False, mask_attention=True)
+        result['sparse'] = measure(args, opts.batch_size, opts.objects, box, opts.repeats, opts.warmup,
+                                   sparse_objects=True, mask_attention=True)
+        print('{}x{} boxes: padding diff {:.1e}, attend diff {:.1e} (nystrom {:.1e}), sparse diff {:.1e}, '
+              'grad diff {:.1e}, dense {:.0f}ms, masked {:.0f}ms, sparse {:.0f}ms'.format(
+                  box[0], box[1], result['padding_diff'], result['attend_diff'], result['attend_diff_nystrom'],
+                  result['output_diff'], result['grad_diff'], result['dense']['median_ms'],
+                  result['masked']['median_ms'], result['sparse']['median_ms']), file=sys.stderr)
+        results.append(result)
+
+    write_report('sparse', {'batch_size': opts.batch_size, 'objects': opts.objects, 'overrides': opts.set,
+                            'repeats': opts.repeats, 'warmup': opts.warmup}, results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
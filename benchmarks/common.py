@@ -0,0 +1,166 @@
+'''
+Helpers shared by the benchmarks: access to the rdnet modules and to train_arg.txt from any working directory,
+overrides of its values from the command line, per-configuration process isolation and JSON reports that can
+be compared across commits.
+'''
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'rdnet'))
+
+
+def parse_list(text, cast=int):
+    return [cast(value) for value in text.split(',') if value != '']
+
+
+def parse_value(key, current, text):
+    if key == 'transformer':
+        from args import TRANSFORMERS
+        return TRANSFORMERS[text]
+    if isinstance(current, bool):
+        return text.lower() in ('1', 'true', 'yes')
+    if isinstance(current, list):
+        return parse_list(text, type(current[0]) if current else int)
+    if isinstance(current, (int, float)):
+        return type(current)(text)
+    return text
+
+
+def load_args(overrides=()):
+    '''
+    Description: Reads train_arg.txt like the training script, then applies overrides given as key=value strings,
+                 lists being comma separated as in the config file
+    '''
+    from args import Arg_train
+
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        args = Arg_train()
+    finally:
+        os.chdir(cwd)
+
+    for override in overrides:
+        key, value = override.split('=', 1)
+        if not hasattr(args, key):
+            raise KeyError('Unknown argument {} in override {}'.format(key, override))
+        setattr(args, key, parse_value(key, getattr(args, key), value))
+
+    args.image_size = [args.image_height, args.image_width]
+    return args
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def now(device=None):
+    '''
+    Return: Current time in seconds once the pending work of device is done
+    '''
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.perf_counter()
+
+
+def timeit(fn, repeats, warmup=1, device=None):
+    '''
+    Return: Wall time in milliseconds of every call of fn after the warmup calls
+    '''
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = now(device)
+        fn()
+        times.append((now(device) - start) * 1e3)
+    return times
+
+
+def summarize(times):
+    ordered = sorted(times)
+    return {'median_ms': ordered[len(ordered) // 2], 'min_ms': ordered[0],
+            'mean_ms': sum(ordered) / len(ordered), 'runs': len(ordered)}
+
+
+def _run_child(queue, fn, fn_args):
+    try:
+        queue.put(('ok', fn(*fn_args)))
+    except BaseException:
+        queue.put(('error', traceback.format_exc()))
+
+
+def run_isolated(fn, *fn_args):
+    '''
+    Description: Runs fn in a fresh process so that the peak RSS it reports only covers its own configuration
+    Return: The value returned by fn, or a dictionary holding the traceback under 'error' when it failed
+    '''
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_child, args=(results, fn, fn_args))
+    process.start()
+    while True:
+        try:
+            status, value = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # a process killed by the OOM killer never reports back
+            if not process.is_alive():
+                status, value = 'error', 'process exited with code {}'.format(process.exitcode)
+                break
+    process.join()
+
+    if status == 'error':
+        return {'error': value.strip().splitlines()[-1], 'traceback': value}
+    return value
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(benchmark, config, results, output):
+    '''
+    Description: Writes the results with the information needed to compare them across commits and machines,
+                 to stdout when output is '-'
+    '''
+    report = {
+        'benchmark': benchmark,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'config': config,
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if output == '-':
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print('Wrote {} results to {}'.format(len(results), output))
+    return report
@@ -1,8 +1,15 @@
 import configparser
 
-from nystrom_attention import Nystromer
 from torch import nn
 
+from blocks import Nystromer, Transformer
+
+
+TRANSFORMERS = {
+    'nystrom': Nystromer,
+    'plain': Transformer,
+}
+
 
 class Arg_train:
     def __init__(self):
@@ -11,11 +18,18 @@ class Arg_train:
         config = configs['COLAB']
         # drive/MyDrive/dataset
         self.data_path = config['data_path']
+        # root of the memory-mapped shards written by shards.py, empty to decode raw files
+        self.shard_path = config['shard_path']
+        # directory written by embed_store.py, empty to read the bbox_embed files one by one
+        self.embed_store = config['embed_store']
+        self.embed_cache_mb = float(config['embed_cache_mb'])  # 0 disables the per-worker LRU
         self.image_height = int(config['image_height'])  # 480
         self.image_width = int(config['image_width'])  # 640
         self.image_size = []
         self.image_size.append(self.image_height)
         self.image_size.append(self.image_width)
+        # resolution of the dataset frames, in which the detector boxes and the Eigen crop are given
+        self.source_size = [int(config['source_height']), int(config['source_width'])]  # 480, 640
         self.patch_size = int(config['patch_size'])  # 32
         self.knowledge_dims = list(
             map(int, config['knowledge_dims'].split(',')))  # 4096, 2048, 1024
@@ -28,6 +42,7 @@ class Arg_train:
             map(int, config['hooks'].split(',')))  # 3, 6, 9, 12
         self.activation = nn.SiLU
         self.batch_size = int(config['batch_size'])  # 4
+        self.bucket_objects = config.getboolean('bucket_objects')  # batch images with similar object counts
         self.num_epochs = int(config['num_epochs'])  # 50
         self.optim = config['optim']
         self.schedule = config['schedule']
@@ -35,12 +50,31 @@ class Arg_train:
         self.weight_decay = float(config['weight_decay'])  # 1e-2
         self.adam_eps = float(config['adam_eps'])  # 1e-3
         self.num_threads = int(config['num_threads'])  # 1
+        self.eval_threads = int(config['eval_threads'])  # DataLoader workers of online_eval and test
+        self.prefetch_factor = int(config['prefetch_factor'])  # batches loaded ahead by each worker
+        self.persistent_workers = config.getboolean('persistent_workers')  # keep the workers between epochs
+        self.worker_start_method = config['worker_start_method']  # of persistent workers, empty for the default
+        self.worker_threads = int(config['worker_threads'])  # intra-op threads of each worker, 0 leaves torch's
+        self.tune_workers = config.getboolean('tune_workers')  # pick num_threads and prefetch_factor at startup
+        self.prefetch = config.getboolean('prefetch')  # move the next batch to the device during the current step
+        self.device_normalize = config.getboolean('device_normalize')  # normalize images on the device
+        self.augment = config.getboolean('augment')  # augment the train batches on the device, see augment.py
+        self.augment_prob = float(config['augment_prob'])  # 0.5, gamma, brightness and colour
+        self.flip_prob = float(config['flip_prob'])  # 0.5
+        self.crop_scale = float(config['crop_scale'])  # smallest side of the random crops, 1 disables them
+        self.amp = config.getboolean('amp')  # False
+        self.amp_dtype = config['amp_dtype']  # bfloat16 or float16
         self.mode = 'train'
         self.patience = int(config['patience'])
         self.thresh = float(config['thresh'])
         self.checkpoint_path = config['checkpoint_path']
+        self.keep_checkpoints = int(config['keep_checkpoints'])  # periodic checkpoints kept, 0 keeps all
+        self.async_checkpoint = config.getboolean('async_checkpoint')  # write checkpoints from a background thread
         self.landmarks = int(config['landmarks'])  # 512
-        self.retrain = True
+        self.sparse_objects = config.getboolean('sparse_objects')
+        # load only the weights of checkpoint_path and start a new optimization, instead of resuming
+        self.retrain = config.getboolean('retrain')
+        self.seed = int(config['seed'])  # shuffling of the train split
         self.eps = float(config['eps'])
         self.trimmed = float(config['trimmed'])
         self.num_scale = int(config['num_scale'])
@@ -51,14 +85,27 @@ class Arg_train:
         self.variance_focus = float(config['focus'])
         self.model_name = config['model']
         self.gpu = 0
+        self.distributed = config.getboolean('distributed')  # False
+        self.dist_backend = config['dist_backend']  # nccl, or gloo for CPU processes
+        self.dist_url = config['dist_url']
+        self.world_size = int(config['world_size'])  # processes to spawn without GPUs
+        self.rank = 0
+        self.local_world_size = 1  # processes sharing the cores of the node, set by main_worker
+        self.check_numerics = config.getboolean('check_numerics')  # False
         self.log_directory = config['log_directory']
         self.do_online_eval = True
-        self.transformer = Nystromer
+        self.transformer = TRANSFORMERS[config['transformer']]  # nystrom
+        self.mask_attention = config.getboolean('mask_attention')
         self.log_freq = int(config['log_freq'])  # 100
+        self.profile_freq = int(config['profile_freq'])  # steps between profiled steps, 0 disables
+        self.profile_trace = config['profile_trace']  # directory of the torch.profiler trace, empty disables
         self.save_freq = int(config['save_freq'])  # 500
         self.eval_summary_directory = ''
         self.min_depth_eval = float(config['min_depth_eval'])  # 1e-3
         self.max_depth_eval = float(config['max_depth_eval'])  # 80
+        self.eval_median = config['eval_median']  # exact or histogram
         self.eval_freq = int(config['eval_freq'])  # 500
+        self.eval_cache_mb = float(config['eval_cache_mb'])  # keep the decoded online_eval samples in memory
+        self.eval_cache_dir = config['eval_cache_dir']  # directory keeping them across runs, empty disables it
         self.eigen_crop = True
         self.end_learning_rate = int(config['end_learning_rate'])  # -1
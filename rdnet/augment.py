@@ -0,0 +1,126 @@
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    '''
+    Description: Random augmentation of collated training batches, run by the Prefetcher on the device holding the
+                 batch instead of per sample in the DataLoader workers. Every sample draws its own gamma,
+                 brightness, colour, flip and crop, the geometric ones being applied alike to the image, the depth,
+                 the mask and the boxes. Images are expected in [0, 1], before normalization
+    Params:
+        - prob: Probability of the gamma, brightness and colour augmentation of each sample
+        - gamma: (low, high) range of the gamma applied to the image
+        - brightness: (low, high) range of the factor applied to the whole image
+        - colors: (low, high) range of the factor applied to each channel
+        - flip: Probability of a horizontal flip of each sample
+        - crop_scale: Smallest side of the random crops as a fraction of the frame, every crop being resized back
+                      to the frame, 1 disables cropping
+        - seed: Seed of the parameters, which are drawn on the CPU from (seed, rank, epoch, step) so that they do
+                not depend on how far ahead batches are prepared and a resumed run draws the same ones
+        - rank: Rank of the process, so that every process of a distributed run draws its own parameters
+    '''
+
+    def __init__(self, prob=0.5, gamma=(0.9, 1.1), brightness=(0.75, 1.25), colors=(0.9, 1.1), flip=0.5,
+                 crop_scale=1.0, seed=0, rank=0):
+        self.prob = prob
+        self.gamma = gamma
+        self.brightness = brightness
+        self.colors = colors
+        self.flip = flip
+        self.crop_scale = crop_scale
+        self.seed = seed
+        self.rank = rank
+        self.epoch = 0
+        self.step = 0
+
+    def set_epoch(self, epoch, step=0):
+        self.epoch = epoch
+        self.step = step
+
+    def __call__(self, batch):
+        generator = torch.Generator().manual_seed(hash((self.seed, self.rank, self.epoch, self.step)) & (2 ** 63 - 1))
+        self.step += 1
+
+        image = batch['image']
+        b = image.shape[0]
+
+        def uniform(bounds, *shape):
+            low, high = bounds
+            values = low + (high - low) * torch.rand((b,) + shape, generator=generator)
+            return values.to(image.device, image.dtype)
+
+        def chance(prob):
+            return (torch.rand(b, generator=generator) < prob).to(image.device)
+
+        batch = dict(batch)
+        if self.crop_scale < 1:
+            self.crop(batch, uniform((self.crop_scale, 1)), torch.rand((b, 2), generator=generator))
+        if self.flip > 0:
+            self.hflip(batch, chance(self.flip))
+        if self.prob > 0:
+            batch['image'] = self.photometric(batch['image'], chance(self.prob), uniform(self.gamma),
+                                              uniform(self.brightness), uniform(self.colors, 3))
+        return batch
+
+    @staticmethod
+    def photometric(image, apply, gamma, brightness, colors):
+        '''
+        Description: Same gamma, brightness and colour augmentation as the former DataLoadPreprocess.augment_image,
+                     applied where apply is True
+        '''
+        augmented = image.clamp(min=0) ** gamma[:, None, None, None]
+        augmented = augmented * (brightness[:, None] * colors)[:, :, None, None]
+        augmented = augmented.clamp(0, 1)
+        return torch.where(apply[:, None, None, None], augmented, image)
+
+    @staticmethod
+    def hflip(batch, apply):
+        flip = apply[:, None, None, None]
+        for key in ('image', 'depth', 'mask'):
+            if torch.is_tensor(batch.get(key)):
+                batch[key] = torch.where(flip, batch[key].flip(-1), batch[key])
+
+        # boxes hold (x, y, xmax, ymax) with x along the width
+        boxes = batch['bbox']
+        width = batch['image'].shape[-1]
+        flipped = torch.stack([width - boxes[..., 2], boxes[..., 1], width - boxes[..., 0], boxes[..., 3]], dim=-1)
+        batch['bbox'] = torch.where(apply[:, None, None].to(boxes.device), flipped, boxes)
+
+    @staticmethod
+    def crop(batch, scale, offsets):
+        '''
+        Description: Crops a window of scale times the frame at a random position of every sample and resizes it
+                     back to the frame, in a single grid_sample per tensor
+        Params:
+            - scale: B sides of the windows as a fraction of the frame
+            - offsets: Bx2 positions of the windows in [0, 1] of the free room along the width and the height
+        '''
+        image = batch['image']
+        height, width = image.shape[-2:]
+        offsets = offsets.to(image.device, image.dtype)
+
+        # window centres in the normalized coordinates of affine_grid
+        centres = (1 - scale)[:, None] * (2 * offsets - 1)
+        theta = torch.zeros((len(scale), 2, 3), device=image.device, dtype=image.dtype)
+        theta[:, 0, 0] = scale
+        theta[:, 1, 1] = scale
+        theta[:, :, 2] = centres
+        grid = F.affine_grid(theta, list(image.shape), align_corners=False)
+
+        batch['image'] = F.grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        if torch.is_tensor(batch.get('depth')):
+            batch['depth'] = F.grid_sample(batch['depth'], grid, mode='nearest', align_corners=False)
+        if torch.is_tensor(batch.get('mask')):
+            mask = F.grid_sample(batch['mask'].to(image.dtype), grid, mode='nearest', align_corners=False)
+            batch['mask'] = mask > 0.5
+
+        # pixel position of the top left corner of every window
+        boxes = batch['bbox']
+        left = (1 - scale) * offsets[:, 0] * width
+        top = (1 - scale) * offsets[:, 1] * height
+        origin = torch.stack([left, top, left, top], dim=-1)[:, None].to(boxes.device)
+        limit = torch.tensor([width, height, width, height], device=boxes.device)
+        scale = scale[:, None, None].to(boxes.device)
+        cropped = ((boxes - origin) / scale).round().clamp(min=0)
+        batch['bbox'] = torch.minimum(cropped, limit).to(boxes.dtype)
@@ -2,8 +2,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from einops import rearrange, repeat
+from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
+from nystrom_attention import Nystromformer
 
 
 def _make_fusion_block(features, use_bn, activation):
@@ -82,6 +83,169 @@ class Transpose(nn.Module):
         return x
 
 
+class Attention(nn.Module):
+    def __init__(self, dim, heads=8, dim_head=64, dropout=0.):
+        super().__init__()
+        inner_dim = heads * dim_head
+        self.heads = heads
+        self.dropout = dropout
+        self.to_qkv = nn.Linear(dim, inner_dim * 3, bias=False)
+        self.to_out = nn.Sequential(nn.Linear(inner_dim, dim), nn.Dropout(dropout))
+
+    def forward(self, x, mask=None):
+        q, k, v = self.to_qkv(x).chunk(3, dim=-1)
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=self.heads), (q, k, v))
+
+        if mask is not None:
+            mask = rearrange(mask, 'b n -> b () () n')
+
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0.)
+        out = rearrange(out, 'b h n d -> b n (h d)')
+        return self.to_out(out)
+
+
+class Transformer(nn.Module):
+    '''
+    Description: Plain self-attention Transformer with the same interface as Nystromer, used as fallback when
+                 exact attention is affordable, its mask removes the masked tokens from the keys of every query
+    Params:
+        - dim: dimension of the tokens
+        - depth: number of attention and feed-forward layers
+        - heads: number of attention heads
+        - dim_head: dimension of each attention head
+        - num_landmarks: ignored, accepted so that it can be constructed like Nystromer
+    '''
+
+    def __init__(self, dim, depth, heads=8, dim_head=64, num_landmarks=None, dropout=0.):
+        super().__init__()
+        self.layers = nn.ModuleList()
+
+        for _ in range(depth):
+            self.layers.append(nn.ModuleList([
+                nn.LayerNorm(dim),
+                Attention(dim, heads=heads, dim_head=dim_head, dropout=dropout),
+                nn.LayerNorm(dim),
+                nn.Sequential(nn.Linear(dim, dim * 4), nn.GELU(), nn.Dropout(dropout), nn.Linear(dim * 4, dim)),
+            ]))
+
+    def forward(self, x, mask=None):
+        for attn_norm, attn, ff_norm, ff in self.layers:
+            x = attn(attn_norm(x), mask=mask) + x
+            x = ff(ff_norm(x)) + x
+        return x
+
+
+def batched_pinv(x, iters=6):
+    '''
+    Description: Iterative Moore-Penrose pseudo-inverse of nystrom_attention, its initial scale is taken from every
+                 sample alone instead of from the whole batch, so that a sample does not depend on the others
+    Params:
+        - x: Matrices with shape BxHxMxM
+        - iters: Number of iterations
+    '''
+    abs_x = torch.abs(x)
+    col = abs_x.sum(dim=-1).amax(dim=(1, 2), keepdim=True)
+    row = abs_x.sum(dim=-2).amax(dim=(1, 2), keepdim=True)
+    z = x.transpose(-1, -2) / (col * row).unsqueeze(-1)
+
+    eye = torch.eye(x.shape[-1], device=x.device, dtype=x.dtype)
+    for _ in range(iters):
+        xz = x @ z
+        z = 0.25 * z @ (13 * eye - (xz @ (15 * eye - (xz @ (7 * eye - xz)))))
+    return z
+
+
+def nystrom_attention(attn, x, mask=None):
+    '''
+    Description: Forward of a NystromAttention module of nystrom_attention whose output only depends on the
+                 unmasked tokens of each sequence. The zeros padding the sequences to a multiple of num_landmarks
+                 are unmasked tokens, as they are without a mask, the landmarks are averaged over the exact number
+                 of their unmasked tokens and the pseudo-inverse is scaled per sample by batched_pinv. A sequence
+                 without any masked token then gives the same output with or without a mask, whatever the other
+                 sequences of its batch
+    Params:
+        - attn: NystromAttention holding the parameters
+        - x: Normalized tokens with shape BxNxD
+        - mask: Optional boolean masks with shape BxN, False for the tokens left out of the keys
+    '''
+    h, m = attn.heads, attn.num_landmarks
+    n = x.shape[1]
+    padding = -n % m
+    x = F.pad(x, (0, 0, padding, 0), value=0)
+
+    q, k, v = attn.to_qkv(x).chunk(3, dim=-1)
+    q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+    if mask is not None:
+        mask = rearrange(F.pad(mask, (padding, 0), value=True), 'b n -> b () n')
+        q, k, v = map(lambda t: t * mask[..., None], (q, k, v))
+    q = q * attn.scale
+
+    l = x.shape[1] // m
+    q_landmarks = reduce(q, '... (n l) d -> ... n d', 'sum', l=l)
+    k_landmarks = reduce(k, '... (n l) d -> ... n d', 'sum', l=l)
+    if mask is None:
+        divisor = l
+    else:
+        landmark_counts = reduce(mask, '... (n l) -> ... n', 'sum', l=l)
+        divisor = landmark_counts.clamp(min=1)[..., None]
+        mask_landmarks = landmark_counts > 0
+    q_landmarks = q_landmarks / divisor
+    k_landmarks = k_landmarks / divisor
+
+    sim1 = q @ k_landmarks.transpose(-1, -2)
+    sim2 = q_landmarks @ k_landmarks.transpose(-1, -2)
+    sim3 = q_landmarks @ k.transpose(-1, -2)
+    if mask is not None:
+        mask_value = -torch.finfo(q.dtype).max
+        sim1 = sim1.masked_fill(~(mask[..., None] & mask_landmarks[..., None, :]), mask_value)
+        sim2 = sim2.masked_fill(~(mask_landmarks[..., None] & mask_landmarks[..., None, :]), mask_value)
+        sim3 = sim3.masked_fill(~(mask_landmarks[..., None] & mask[..., None, :]), mask_value)
+
+    attn1, attn2, attn3 = (sim.softmax(dim=-1) for sim in (sim1, sim2, sim3))
+    out = (attn1 @ batched_pinv(attn2, attn.pinv_iterations)) @ (attn3 @ v)
+    if attn.residual:
+        out = out + attn.res_conv(v)
+
+    out = rearrange(out, 'b h n d -> b n (h d)', h=h)
+    return attn.to_out(out)[:, padding:]
+
+
+class Nystromer(Nystromformer):
+    '''
+    Description: Nystromformer running its attention through nystrom_attention, with the modules and parameters
+                 of Nystromformer. In the original, the landmarks of a masked sequence leave out the zeros padding
+                 it to a multiple of num_landmarks while those of an unmasked one count them, and the
+                 pseudo-inverse is scaled over the whole batch, so that the output of an unpadded sample changed
+                 with the padding of the others in its batch
+    '''
+
+    def forward(self, x, mask=None):
+        for attn, ff in self.layers:
+            x = nystrom_attention(attn.fn, attn.norm(x), mask) + x
+            x = ff(x) + x
+        return x
+
+
+def pack_tokens(masks, k=None):
+    '''
+    Description: Computes where the masked tokens of every sequence go in a padded batch whose length is the
+                 largest number of masked tokens among the sequences instead of the full sequence length
+    Params:
+        - masks: Boolean masks with shape BxP
+        - k: Largest number of masked tokens when already known on the host, read from masks otherwise
+    Return:
+        - index: Positions with shape BxK of the packed tokens inside their sequence, in their original order
+        - valid: Boolean masks with shape BxK, False for the padding
+    '''
+    if k is None:
+        k = int(masks.sum(dim=1).max())
+    k = max(k, 1)
+    index = torch.argsort((~masks).to(torch.uint8), dim=1, stable=True)[:, :k]
+    valid = torch.gather(masks, 1, index)
+    return index, valid
+
+
 class InjectionBlock(nn.Module):
     '''
     Description:
@@ -96,10 +260,14 @@ class InjectionBlock(nn.Module):
         - max_patches: maximum number of patches that could be fed
         - use_readout: type of readout (ignore/add/proj)
         - transformer: the class of transformer to be used
+        - mask_attention: restrict the attention of each object to the patches inside its mask, the other patches
+                          are left out of the transformer entirely and passed through unchanged
     '''
 
-    def __init__(self, emb_size, inp_dim, out_dim, max_patches, use_readout, transformer, landmarks, **kwargs):
+    def __init__(self, emb_size, inp_dim, out_dim, max_patches, use_readout, transformer, landmarks,
+                 mask_attention=False, **kwargs):
         super().__init__()
+        self.mask_attention = mask_attention
         self.readout = get_readout_oper(inp_dim=out_dim, out_dims=[
                                         out_dim], use_readout=use_readout, **kwargs)
         self.rel_trans = nn.Sequential(nn.Linear(emb_size, out_dim),
@@ -112,7 +280,97 @@ class InjectionBlock(nn.Module):
         self.transformer = transformer(
             dim=out_dim, depth=1, num_landmarks=landmarks)
 
-    def forward(self, imgs, embs, masks):
+    def relate(self, embs, objects=None):
+        '''
+        Params:
+            - embs: Batch of embeddings with shape BxNxC
+            - objects: Batch of masks with shape BxN, False for the padded objects which are then left out of
+                       the keys of the attention
+        Return: Relation-aware embeddings with shape BxNxD, shared by every patch sequence of the same object
+        '''
+        if objects is None:
+            return self.rel_trans(embs)
+
+        proj, transformer = self.rel_trans
+        return transformer(proj(embs), mask=objects)
+
+    def inject(self, imgs, embs, masks, index=None):
+        '''
+        Params:
+            - imgs: Batch of patch sequences with shape BxPxD, one sequence per object
+            - embs: Batch of relation-aware embeddings with shape BxD as returned by relate
+            - masks: Batch of masks with shape BxP
+            - index: Positions with shape BxP of the patches inside the image when the sequences were packed
+                     by pack_tokens, masks then marks the padding and the transformer ignores it
+        Return:
+            - Processed patches
+            - Processed embeddings
+        '''
+        b, p, _ = imgs.shape
+        y = self.proj(imgs)
+        y = y * embs.unsqueeze(1)
+
+        cls_token = repeat(self.cls_token, 'p d -> b p d', b=b)
+        if index is None:
+            y = y + self.pos_emb[:, :p]
+        else:
+            y = y + self.pos_emb[0, index]
+        y = torch.cat([cls_token, y], dim=1)
+
+        cls_masks = torch.ones((b, 1), dtype=torch.bool).to(masks.device)
+        masks = torch.cat([cls_masks, masks], dim=1)
+
+        if index is None and not self.mask_attention:
+            y = self.transformer(y)
+            y = self.readout[0](y)
+            x = y.mean(dim=1)
+        else:
+            if index is None:
+                y = self.attend(y, masks)
+            else:
+                y = self.transformer(y, mask=masks)
+            y = self.readout[0](y)
+            valid = masks[:, 1:].unsqueeze(2)
+            x = (y * valid).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+
+        return y, x
+
+    def attend(self, y, masks):
+        '''
+        Params:
+            - y: Batch of token sequences with shape BxPxD
+            - masks: Batch of masks with shape BxP
+        Return: The sequences where only the masked tokens went through the transformer, packed by pack_tokens
+                so that the cost follows the number of masked tokens, while the others are returned unchanged
+        '''
+        # the packed length needs the token counts on the host, they are read once and every choice below is
+        # made from this copy, the rows being selected by index so that no other synchronization is needed
+        counts = masks.sum(dim=1).cpu()
+        full = counts == masks.shape[1]
+        if full.all():
+            return self.transformer(y)
+
+        out = y.clone()
+        rows = full.nonzero().flatten()
+        if len(rows) > 0:
+            rows = rows.to(y.device)
+            out[rows] = self.transformer(y[rows])
+
+        rows = (~full).nonzero().flatten()
+        k = int(counts[rows].max())
+        rows = rows.to(y.device)
+        y, masks = y[rows], masks[rows]
+        index, valid = pack_tokens(masks, k)
+        batch_index = repeat(torch.arange(len(y), device=y.device), 'b -> b k', k=index.shape[1])
+
+        packed = self.transformer(y[batch_index, index], mask=valid)
+        # the padding of the packed sequences points to tokens outside of the masks, which are put back as they were
+        packed = torch.where(valid.unsqueeze(2), packed, y[batch_index, index])
+        out[rows] = y.scatter(1, repeat(index, 'b k -> b k d', d=y.shape[2]), packed)
+
+        return out
+
+    def forward(self, imgs, embs, masks, objects=None):
         '''
         Params:
             - B is number of instances in batch, N is number of objects for each instance,
@@ -121,29 +379,27 @@ class InjectionBlock(nn.Module):
             - imgs: Batch of patches with shape BxNxPxD
             - embs: Batch of embeddings with shape BxNxC
             - masks: Batch of masks to be processed with shape (BxN)xP
+            - objects: Batch of masks with shape BxN, False for the padded objects which are skipped and
+                       come out as zeros
         Return:
             - Processed patches
             - Processed embeddings
         '''
-        b, n, p, _ = imgs.shape
-        x = self.rel_trans(embs)
-        x = repeat(x, 'b n d -> (b n) p d', p=p)
-
-        y = self.proj(imgs)
-        y = rearrange(y, 'b n p d -> (b n) p d')
-        y *= x
+        n = imgs.shape[1]
+        x = self.relate(embs, objects)
+        imgs = rearrange(imgs, 'b n p d -> (b n) p d')
+        x = rearrange(x, 'b n d -> (b n) d')
 
-        cls_token = repeat(self.cls_token, 'p d -> b p d', b=b*n)
-        y += self.pos_emb[:, :p]
-        y = torch.cat([cls_token, y], dim=1)
-
-        cls_masks = torch.ones((b * n, 1), dtype=torch.bool).to(masks.device)
-        masks = torch.cat([cls_masks, masks], dim=1)
-        # y = self.transformer(y, mask=masks)
-        y = self.transformer(y)
-        y = self.readout[0](y)
+        if objects is None:
+            y, x = self.inject(imgs, x, masks)
+        else:
+            keep = objects.flatten()
+            y_keep, x_keep = self.inject(imgs[keep], x[keep], masks[keep])
+            y = y_keep.new_zeros((len(keep),) + y_keep.shape[1:])
+            x = x_keep.new_zeros((len(keep),) + x_keep.shape[1:])
+            y[keep] = y_keep
+            x[keep] = x_keep
 
-        x = y.mean(dim=1)
         x = rearrange(x, '(b n) d -> b n d', n=n)
         y = rearrange(y, '(b n) p d -> b n p d', n=n)
 
@@ -0,0 +1,197 @@
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+
+def to_cpu(value):
+    '''
+    Description: Copies every tensor of a nested state to the CPU, so that training can keep updating the
+                 originals while the copy is being written
+    '''
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        return type(value)((key, to_cpu(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu(item) for item in value)
+    return value
+
+
+def rng_state():
+    '''
+    Return: States of every random number generator used by training, to be saved along a checkpoint
+    '''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([value.cpu() for value in state['cuda']])
+
+
+def seed_rng(seed):
+    '''
+    Description: Seeds every random number generator used by training, for processes whose state is not saved
+    '''
+    random.seed(seed)
+    np.random.seed(seed & (2 ** 32 - 1))
+    torch.manual_seed(seed)
+
+
+class CheckpointManager(object):
+    '''
+    Description: Writes checkpoints of a training run from a background thread. Each file is written under a
+                 temporary name then renamed, so that a crash never leaves a truncated checkpoint, and a state
+                 saved under several names is written once and hard-linked to the others
+    Params:
+        - directory: Directory receiving the checkpoints
+        - keep: Number of files kept in each group, the oldest ones being removed first, groups missing here
+                are kept entirely
+        - async_save: Write from a background thread, otherwise save blocks until the files are written
+        - patterns: Regular expressions matching the names of the files of each group, their first group
+                    capturing the global step. The files of a group already in directory, written by an earlier
+                    run or before a restart, are then removed by retention like the ones written by this one
+    '''
+
+    def __init__(self, directory, keep=None, async_save=True, patterns=None):
+        self.directory = directory
+        self.keep = dict(keep or {})
+        self.async_save = async_save
+        self.groups = {}
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        for group, pattern in (patterns or {}).items():
+            self.scan(group, pattern)
+
+        self.pending = queue.Queue()
+        self.thread = None
+        if async_save:
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self, state, names):
+        '''
+        Params:
+            - state: Dictionary of state dicts and values, copied to the CPU before save returns
+            - names: List of (name, group) pairs the checkpoint is saved under, the retention of keep being
+                     applied to each group
+        '''
+        self.raise_error()
+        if not names:
+            return
+
+        job = (to_cpu(state), list(names))
+        if self.thread is None:
+            self.write(*job)
+        else:
+            self.pending.put(job)
+
+    def work(self):
+        while True:
+            job = self.pending.get()
+            try:
+                if job is None:
+                    return
+                self.write(*job)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.pending.task_done()
+
+    def write(self, state, names):
+        first = self.path(names[0][0])
+        temp = first + '.tmp'
+        torch.save(state, temp)
+        os.replace(temp, first)
+
+        for name, _ in names[1:]:
+            link = self.path(name)
+            temp = link + '.tmp'
+            if os.path.lexists(temp):
+                os.remove(temp)
+            try:
+                os.link(first, temp)
+            except OSError:
+                # file systems without hard links get a copy
+                shutil.copyfile(first, temp)
+            os.replace(temp, link)
+
+        for name, group in names:
+            self.retain(group, self.path(name))
+
+    def scan(self, group, pattern):
+        '''
+        Description: Adds the files of directory whose names match pattern to group, oldest step first
+        '''
+        pattern = re.compile(pattern)
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.fullmatch(name)
+            if match is not None:
+                found.append((int(match.group(1)), self.path(name)))
+        files = self.groups.setdefault(group, deque())
+        files.extendleft(path for _, path in sorted(found, reverse=True) if path not in files)
+
+    def retain(self, group, path):
+        files = self.groups.setdefault(group, deque())
+        if path in files:
+            files.remove(path)
+        files.append(path)
+
+        keep = self.keep.get(group)
+        while keep is not None and len(files) > keep:
+            old = files.popleft()
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint to {} failed'.format(self.directory)) from error
+
+    def wait(self):
+        '''
+        Description: Blocks until every pending checkpoint is written
+        '''
+        if self.thread is not None:
+            self.pending.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    @staticmethod
+    def restore(path, model=None, optimizer=None, scheduler=None, scaler=None, map_location='cpu'):
+        '''
+        Description: Loads a checkpoint and restores the state of every object given
+        Return: The whole checkpoint dictionary for the remaining values such as global_step
+        '''
+        checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+        for key, target in (('model', model), ('optimizer', optimizer), ('scheduler', scheduler), ('scaler', scaler)):
+            if target is not None and key in checkpoint:
+                target.load_state_dict(checkpoint[key])
+        return checkpoint
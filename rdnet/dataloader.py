@@ -16,7 +16,7 @@
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, default_collate
 import torch.utils.data.distributed
 import torch.distributed as dist
 from torchvision import transforms
@@ -25,8 +25,16 @@ import os
 import random
 import json
 import argparse
+import hashlib
+import functools
+import time
+from collections import OrderedDict
 import sys
 
+from embed_store import EmbedStore, INDEX_FILE as EMBED_INDEX_FILE
+from geometry import Geometry
+from augment import BatchAugment
+
 
 def _is_pil_image(img):
     return isinstance(img, Image.Image)
@@ -36,53 +44,518 @@ def _is_numpy_image(img):
     return isinstance(img, np.ndarray) and (img.ndim in {2, 3})
 
 
-def preprocessing_transforms(mode):
+def normalization():
+    return transforms.Normalize(
+        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+
+def preprocessing_transforms(mode, normalize=True):
     return transforms.Compose([
-        ToTensor(mode=mode)
+        ToTensor(mode=mode, normalize=normalize)
     ])
 
 
+def normalize_on_device(args):
+    # BatchAugment works on images in [0, 1], so they are normalized by the Prefetcher once augmented
+    return args.device_normalize or args.augment
+
+
+def make_dataset(args, mode):
+    # with device_normalize the images are normalized by the Prefetcher once on the device
+    transform = preprocessing_transforms(mode, normalize=not normalize_on_device(args))
+    if args.shard_path != '':
+        from shards import ShardedDataset
+        return ShardedDataset(args, mode, transform=transform)
+
+    return DataLoadPreprocess(args, mode, transform=transform)
+
+
+def pad_collate(batch):
+    '''
+    Description: Collates samples with different numbers of detected objects by padding their embeddings and
+                 boxes with zeros up to the largest count of the batch, the added 'objects' entry is a BxN mask
+                 which is False for the padding so that the model skips it. It is None when every sample has the
+                 same count, which is known here on the host, so that the model keeps its unpadded path without
+                 reading the mask back from the device
+    '''
+    counts = [len(sample['embedding']) for sample in batch]
+    n = max(counts)
+
+    embeddings = batch[0]['embedding'].new_zeros((len(batch), n) + batch[0]['embedding'].shape[1:])
+    bboxes = batch[0]['bbox'].new_zeros((len(batch), n) + batch[0]['bbox'].shape[1:])
+    objects = torch.zeros((len(batch), n), dtype=torch.bool)
+    for idx, (sample, count) in enumerate(zip(batch, counts)):
+        embeddings[idx, :count] = sample['embedding']
+        bboxes[idx, :count] = sample['bbox']
+        objects[idx, :count] = True
+
+    result = default_collate([{key: value for key, value in sample.items() if key not in ('embedding', 'bbox')}
+                              for sample in batch])
+    result.update({'embedding': embeddings, 'bbox': bboxes, 'objects': objects if min(counts) < n else None})
+    return result
+
+
+def file_checksum(path):
+    '''
+    Return: sha1 of the content of the file at path, None when there is none
+    '''
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_fingerprint(args, mode):
+    '''
+    Return: Fingerprint given to SampleCache for the samples of mode, holding the settings they depend on and the
+            checksums of the indexes of the dataset, so that a dataset rewritten in place never serves stale samples
+    '''
+    fingerprint = {'data_path': args.data_path, 'shard_path': args.shard_path, 'embed_store': args.embed_store,
+                   'mode': mode, 'image_size': list(args.image_size), 'source_size': list(args.source_size),
+                   'normalized': not normalize_on_device(args),
+                   'data_json': file_checksum(os.path.join(args.data_path, 'data.json'))}
+    if args.shard_path != '':
+        # shards imports this module at its top, so it can only be imported once this module is loaded
+        from shards import INDEX_FILE as SHARD_INDEX_FILE, shard_dir
+        fingerprint['shard_index'] = file_checksum(os.path.join(shard_dir(args.shard_path, mode), SHARD_INDEX_FILE))
+    if args.embed_store != '':
+        fingerprint['embed_index'] = file_checksum(os.path.join(args.embed_store, EMBED_INDEX_FILE))
+    return fingerprint
+
+
+class SampleCache(Dataset):
+    '''
+    Description: Keeps the samples of a dataset once decoded, resized and transformed, so that datasets read again
+                 and again such as the online_eval split only pay for their decoding once. Samples are kept in a
+                 per-process LRU bounded in memory, and optionally written to a directory that outlives the run
+    Params:
+        - dataset: Dataset whose samples are dictionaries of tensors, arrays and plain values
+        - cache_mb: Size in megabytes of the in-memory LRU, 0 disables it
+        - cache_dir: Directory receiving one file per sample, empty to keep the samples in memory only
+        - fingerprint: Dictionary of the settings the samples depend on, samples written with other settings
+                       go to another sub-directory of cache_dir and are never read back
+    '''
+
+    def __init__(self, dataset, cache_mb=0, cache_dir='', fingerprint=None):
+        self.dataset = dataset
+        self.cache_bytes = int(cache_mb * 2 ** 20)
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+        self.cache_dir = ''
+        if cache_dir != '':
+            digest = hashlib.sha1(json.dumps(fingerprint or {}, sort_keys=True).encode()).hexdigest()[:16]
+            self.cache_dir = os.path.join(cache_dir, digest)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getattr__(self, name):
+        # object_counts, filenames and the like of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @staticmethod
+    def nbytes(sample):
+        return sum(value.nbytes for value in sample.values() if torch.is_tensor(value) or isinstance(value, np.ndarray))
+
+    def __getitem__(self, idx):
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+
+        sample = self.load(idx)
+        size = self.nbytes(sample)
+        if size <= self.cache_bytes:
+            self.cache[idx] = sample
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_bytes:
+                _, old = self.cache.popitem(last=False)
+                self.cached_bytes -= self.nbytes(old)
+        return sample
+
+    def load(self, idx):
+        if self.cache_dir == '':
+            return self.dataset[idx]
+
+        path = os.path.join(self.cache_dir, '{}.pt'.format(idx))
+        if os.path.exists(path):
+            return torch.load(path, weights_only=False)
+
+        sample = self.dataset[idx]
+        # written under a temporary name then renamed so that concurrent or interrupted runs never read half a file
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save(sample, temp)
+        os.replace(temp, path)
+        return sample
+
+
+def init_worker(threads, worker_id):
+    # every worker otherwise starts as many intra-op threads as there are cores
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+
+def worker_options(args, num_workers, prefetch_factor=None, persistent=None):
+    '''
+    Return: Keyword arguments of DataLoader for num_workers workers, each pinned to worker_threads intra-op threads
+    '''
+    options = {'num_workers': num_workers}
+    if num_workers > 0:
+        persistent = args.persistent_workers if persistent is None else persistent
+        options.update(prefetch_factor=prefetch_factor or args.prefetch_factor,
+                       persistent_workers=persistent,
+                       worker_init_fn=functools.partial(init_worker, args.worker_threads))
+        if persistent and args.worker_start_method != '':
+            # a forked worker kept for the whole run pins a copy-on-write snapshot of the memory of the trainer
+            # at the time it was forked, which for the online_eval workers includes gradients and optimizer states
+            options['multiprocessing_context'] = args.worker_start_method
+    return options
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def tune_workers(args, dataset, batches=20, **loader_kwargs):
+    '''
+    Description: Measures the samples per second of a burst of batches for every number of workers up to the cores
+                 of the process, in powers of two, and every prefetch_factor among 2 and 4, then keeps the fastest
+                 setting in args.num_threads and args.prefetch_factor. Workers load num_workers * prefetch_factor
+                 batches ahead as soon as they start, so that as many batches are drained before timing and the timed
+                 burst is a multiple of it, otherwise the batches prefetched while the loader starts would be
+                 counted for free and favour the largest settings. The cores of a node are shared by its
+                 local_world_size processes, and in a distributed run only rank 0 measures and broadcasts its
+                 setting. Samples are drawn with their own generators so that tuning leaves the random state of
+                 training untouched
+    Params:
+        - args: Arg_train instance updated with the best setting
+        - dataset: Dataset to be loaded
+        - batches: Smallest number of batches timed for every setting
+        - loader_kwargs: Remaining arguments of DataLoader such as batch_size and collate_fn
+    '''
+    setting = [None, None]
+    if not args.distributed or dist.get_rank() == 0:
+        cores = max(available_cores() // max(args.local_world_size, 1), 1)
+        max_workers = max(cores // max(args.worker_threads, 1), 1)
+        settings = [(0, None)]
+        num_workers = 1
+        while num_workers <= max_workers:
+            settings += [(num_workers, 2), (num_workers, 4)]
+            num_workers *= 2
+
+        results = []
+        for idx, (num_workers, prefetch_factor) in enumerate(settings):
+            warmup = max(num_workers * (prefetch_factor or 0), 1)
+            timed = warmup * -(-batches // warmup)
+            # each setting reads other samples, so that later ones do not benefit from the page cache
+            sampler = torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(idx))
+            loader = DataLoader(dataset, sampler=sampler, generator=torch.Generator().manual_seed(idx),
+                                **worker_options(args, num_workers, prefetch_factor, persistent=False),
+                                **loader_kwargs)
+            samples, counted, start = 0, 0, None
+            for step, batch in enumerate(loader, 1):
+                if step == warmup:
+                    start = time.perf_counter()
+                elif step > warmup:
+                    samples += len(batch['image'])
+                    counted += 1
+                    if counted == timed:
+                        break
+            elapsed = time.perf_counter() - start if start is not None else 0
+            del loader
+
+            rate = samples / elapsed if elapsed > 0 else 0
+            results.append((rate, num_workers, prefetch_factor))
+            print('Loader with {} workers, prefetch_factor {}: {:.1f} samples/s over {} batches'.format(
+                num_workers, prefetch_factor or '-', rate, counted))
+
+        _, num_workers, prefetch_factor = max(results, key=lambda result: result[0])
+        setting = [num_workers, prefetch_factor]
+
+    if args.distributed:
+        dist.broadcast_object_list(setting, src=0)
+    args.num_threads, prefetch_factor = setting
+    args.prefetch_factor = prefetch_factor or args.prefetch_factor
+    print('Loading with {} workers, prefetch_factor {}'.format(args.num_threads, args.prefetch_factor))
+
+
 class Loader(object):
     def __init__(self, args, mode):
+        self.batch_size = args.batch_size
+        self.augment = None
         if mode == 'train':
-            self.training_samples = DataLoadPreprocess(
-                args, mode, transform=preprocessing_transforms(mode))
-            self.train_sampler = None
-            self.data = DataLoader(self.training_samples, args.batch_size,
-                                   shuffle=(self.train_sampler is None),
-                                   num_workers=args.num_threads,
-                                   pin_memory=True,
-                                   sampler=self.train_sampler)
+            self.training_samples = make_dataset(args, mode)
+            num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if args.distributed else (1, 0)
+            if args.augment:
+                self.augment = BatchAugment(prob=args.augment_prob, flip=args.flip_prob,
+                                            crop_scale=args.crop_scale, seed=args.seed, rank=rank)
+            if args.tune_workers:
+                tune_workers(args, self.training_samples, batch_size=args.batch_size, collate_fn=pad_collate,
+                             pin_memory=True)
+            if args.bucket_objects:
+                self.train_sampler = BucketBatchSampler(self.training_samples.object_counts(), args.batch_size,
+                                                        num_replicas=num_replicas, rank=rank, seed=args.seed)
+                self.data = DataLoader(self.training_samples,
+                                       batch_sampler=self.train_sampler,
+                                       pin_memory=True,
+                                       collate_fn=pad_collate,
+                                       **worker_options(args, args.num_threads))
+            else:
+                self.train_sampler = ResumableSampler(self.training_samples, num_replicas=num_replicas,
+                                                      rank=rank, seed=args.seed)
+                self.data = DataLoader(self.training_samples, args.batch_size,
+                                       pin_memory=True,
+                                       sampler=self.train_sampler,
+                                       collate_fn=pad_collate,
+                                       **worker_options(args, args.num_threads))
 
         elif mode == 'online_eval':
-            self.testing_samples = DataLoadPreprocess(
-                args, mode, transform=preprocessing_transforms(mode))
-            self.eval_sampler = None
+            self.testing_samples = make_dataset(args, mode)
+            if args.eval_cache_mb > 0 or args.eval_cache_dir != '':
+                fingerprint = cache_fingerprint(args, mode)
+                self.testing_samples = SampleCache(self.testing_samples, args.eval_cache_mb, args.eval_cache_dir,
+                                                   fingerprint)
+            if args.distributed:
+                self.eval_sampler = DistributedSamplerNoEvenlyDivisible(self.testing_samples, shuffle=False)
+            else:
+                self.eval_sampler = None
+            # the in-memory cache lives in the workers, which must survive between evaluations
+            persistent = args.persistent_workers or args.eval_cache_mb > 0
             self.data = DataLoader(self.testing_samples, args.batch_size,
                                    shuffle=False,
-                                   num_workers=1,
                                    pin_memory=True,
-                                   sampler=self.eval_sampler)
+                                   sampler=self.eval_sampler,
+                                   collate_fn=pad_collate,
+                                   **worker_options(args, args.eval_threads, persistent=persistent))
 
         elif mode == 'test':
-            self.testing_samples = DataLoadPreprocess(
-                args, mode, transform=preprocessing_transforms(mode))
+            self.testing_samples = make_dataset(args, mode)
             self.data = DataLoader(self.testing_samples,
-                                   args.batch_size, shuffle=False, num_workers=1)
+                                   args.batch_size, shuffle=False,
+                                   collate_fn=pad_collate,
+                                   **worker_options(args, args.eval_threads))
 
         else:
             print(
                 'mode should be one of \'train, test, online_eval\'. Got {}'.format(mode))
 
+    def set_epoch(self, epoch, step=0):
+        '''
+        Description: Sets the shuffling of the train split to the one of epoch and skips its first step batches,
+                     so that a resumed run continues an interrupted epoch without replaying any sample
+        '''
+        self.train_sampler.set_epoch(epoch)
+        if self.augment is not None:
+            self.augment.set_epoch(epoch, step)
+        if isinstance(self.train_sampler, BucketBatchSampler):
+            self.train_sampler.set_start(step)
+        else:
+            self.train_sampler.set_start(step * self.batch_size)
+
+
+class ResumableSampler(Sampler):
+    '''
+    Description: Shuffles the dataset with a seed derived from the epoch and shards it across the processes of a
+                 distributed run like DistributedSampler, padding it with repeated samples so that every process
+                 runs the same number of steps, and can start an epoch after its first samples
+    Params:
+        - dataset: Dataset to be sampled
+        - num_replicas: Number of processes
+        - rank: Rank of the current process
+        - shuffle: Shuffle the indices before sharding
+        - seed: Seed added to the epoch to shuffle
+    '''
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = -(-len(dataset) // num_replicas)
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+
+        total = self.num_samples * self.num_replicas
+        while len(indices) < total:
+            indices += indices[:total - len(indices)]
+
+        return iter(indices[self.rank:total:self.num_replicas][self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        self.start = min(start, self.num_samples)
+
+
+class DistributedSamplerNoEvenlyDivisible(Sampler):
+    '''
+    Description: Shards a dataset across the processes of a distributed run without padding it with repeated
+                 samples, so that evaluation metrics summed over the processes count every sample exactly once
+    Params:
+        - dataset: Dataset to be sharded
+        - num_replicas: Number of processes, defaults to the world size
+        - rank: Rank of the current process, defaults to the global rank
+        - shuffle: Shuffle the indices with a seed derived from the epoch before sharding
+    '''
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.shuffle = shuffle
+        self.num_samples = len(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Description: Batch sampler grouping samples with similar numbers of objects so that pad_collate adds little
+                 padding, the shuffled samples are split into pools of bucket_batches batches, each pool is sorted
+                 by object count and cut into batches, and the order of the batches is shuffled again
+    Params:
+        - counts: Number of objects of every sample of the dataset
+        - batch_size: Number of samples per batch
+        - bucket_batches: Number of batches per pool, larger pools pad less but are less random
+        - num_replicas: Number of processes of a distributed run, each one iterates over its own batches
+        - rank: Rank of the current process
+        - shuffle: Shuffle with a seed derived from the epoch, set through set_epoch
+        - seed: Seed added to the epoch to shuffle
+    '''
+
+    def __init__(self, counts, batch_size, bucket_batches=100, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.counts = np.asarray(counts)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+        num_batches = -(-len(self.counts) // batch_size)
+        # every process runs the same number of steps, which distributed training needs
+        self.num_batches = -(-num_batches // num_replicas)
+
+    def batches(self):
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = rng.permutation(len(self.counts))
+        else:
+            indices = np.arange(len(self.counts))
+
+        pool_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.counts[pool], kind='stable')]
+            batches.extend(pool[idx:idx + self.batch_size].tolist() for idx in range(0, len(pool), self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[idx] for idx in rng.permutation(len(batches))]
+
+        total = self.num_batches * self.num_replicas
+        batches += batches[:total - len(batches)]
+        return batches[self.rank:total:self.num_replicas]
 
-def bbox_resize(location):
-    x_scale = 384 / 640
-    y_scale = 256 / 480
-    x = int(np.round(location[0] * x_scale))
-    y = int(np.round(location[1] * y_scale))
-    xmax = int(np.round(location[2] * x_scale))
-    ymax = int(np.round(location[3] * y_scale))
-    return [x, y, xmax, ymax]
+    def __iter__(self):
+        return iter(self.batches()[self.start:])
+
+    def __len__(self):
+        return self.num_batches - self.start
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        self.start = min(start, self.num_batches)
+
+
+def build_sample(mode, image, depth_gt, bbox, embedding, transform=None, crop=None):
+    '''
+    Description: Builds the sample dictionary from decoded and resized arrays, shared by every dataset
+                 feeding Loader so that packed and raw samples are indistinguishable downstream
+    Params:
+        - mode: One of train, test or online_eval
+        - image: HxWx3 uint8 image already resized to the training resolution
+        - depth_gt: HxW uint16 depth in millimeters, or None when no ground truth is available
+        - bbox: Nx4 boxes already rescaled to the training resolution
+        - embedding: NxC embeddings of the detected objects
+        - transform: Transform applied to the resulting dictionary
+        - crop: (top, bottom, left, right) region of the depth supervised, the whole frame when None
+    '''
+    image = np.asarray(image, dtype=np.float32) / 255.0
+    bbox = np.asarray(bbox, dtype=np.float32)
+    embedding = np.array(embedding, dtype=np.float32)
+
+    if mode == 'test':
+        sample = {'image': image, 'embedding': embedding, 'bbox': bbox}
+    elif depth_gt is None:
+        sample = {'image': image, 'depth': False, 'embedding': embedding,
+                  'bbox': bbox, 'mask': False}
+    else:
+        depth_gt = np.asarray(depth_gt, dtype=np.float32)
+        depth_gt = np.expand_dims(depth_gt, axis=2)
+        if crop is None:
+            mask = np.ones(depth_gt.shape, dtype=bool)
+        else:
+            top, bottom, left, right = crop
+            mask = np.zeros(depth_gt.shape, dtype=bool)
+            mask[top:bottom, left:right] = 1
+        depth_gt = depth_gt / 1000.0
+        mask &= depth_gt > .1
+
+        sample = {'image': image, 'depth': depth_gt,
+                  'embedding': embedding, 'bbox': bbox, 'mask': mask
+                  }
+
+    if transform:
+        sample = transform(sample)
+
+    return sample
 
 
 class DataLoadPreprocess(Dataset):
@@ -100,182 +573,122 @@ class DataLoadPreprocess(Dataset):
         d = json.load(open_file)
         self.filenames = d['idx_to_' + mode + '_files']
         self.idx_to_bbox_embed = d['idx_to_' + mode + '_bbox_embed']
+        # written by pack_dataset.py, which stores the depths as resized uint16 millimeters
+        self.depth_format = d.get('depth_format', 'npz')
+        self.idx_to_objects = d.get('idx_to_' + mode + '_objects')
         open_file.close()
+        if d.get('image_size', args.image_size) != list(args.image_size):
+            print('{} was packed at {}, resizing its samples to {}'.format(
+                args.data_path, d['image_size'], args.image_size))
 
         self.images_path = args.data_path + 'nyu_' + mode + '/'
 
         self.bbox_embed_path = args.data_path + 'bbox_embed/'
+        if args.embed_store != '':
+            self.embed_store = EmbedStore(args.embed_store, args.embed_cache_mb)
+        else:
+            self.embed_store = None
 
         self.depths_path = args.data_path + 'nyu_depth_' + mode + '/'
 
+        self.geometry = Geometry(args.image_size, args.source_size)
+        self.crop = self.geometry.crop()
+
         self.transform = transform
         self.to_tensor = ToTensor
         self.is_for_online_eval = is_for_online_eval
 
-    def __getitem__(self, idx):
-        sample_path = self.filenames[idx]
-        idx_bbox_embed = self.idx_to_bbox_embed[idx]
-        filename = int(sample_path[:-4])
-        size = (384, 256)
-
-        if self.mode == 'train':
-            # set path
-            image_path = self.images_path + sample_path
-            depth_path = self.depths_path + str(filename) + '.npz'
-            bbox_embed_path = self.bbox_embed_path + \
-                str(idx_bbox_embed) + '.npz'
-            # load & resize image
-            image = Image.open(image_path).resize(size, Image.BICUBIC)
-            # load depth
-            f = np.load(depth_path)
-            depth_gt = f['depth'].T
-            f.close()
-            # resize depth
-            img_depth = depth_gt * 1000.0
-            img_depth_uint16 = img_depth.astype(np.uint16)
-            depth_gt = Image.fromarray(
-                img_depth_uint16).resize(size, Image.NEAREST)
-            # load bbox & embed
-            f = np.load(bbox_embed_path)
-            bbox = f['bbox']
-            # resize bbox
-            bbox = np.apply_along_axis(bbox_resize, 1, bbox)
-            embedding = f['embed']
-            f.close()
-
-            image = np.asarray(image, dtype=np.float32) / 255.0
-            depth_gt = np.asarray(depth_gt, dtype=np.float32)
-            depth_gt = np.expand_dims(depth_gt, axis=2)
-            bbox = np.asarray(bbox, dtype=np.float32)
-            embedding = np.asarray(embedding, dtype=np.float32)
-
-            mask = np.zeros(depth_gt.shape, dtype=bool)
-            mask[45:471, 41:601] = 1
-            depth_gt = depth_gt / 1000.0
-            mask &= depth_gt > .1
-
-            # image, depth_gt = self.train_preprocess(image, depth_gt)
-            sample = {'image': image, 'depth': depth_gt,
-                      'embedding': embedding, 'bbox': bbox, 'mask': mask
-                      }
+    def load_image(self, sample_path, size=None):
+        size = size or self.geometry.size
+        image = Image.open(self.images_path + sample_path).resize(size, Image.BICUBIC)
+        return np.asarray(image, dtype=np.uint8)
 
+    def load_depth(self, sample_path, size=None):
+        size = size or self.geometry.size
+        filename = int(sample_path[:-4])
+        if self.depth_format == 'uint16':
+            depth_gt = np.load(self.depths_path + str(filename) + '.npy')
+            if depth_gt.shape == (size[1], size[0]):
+                return depth_gt
+            return np.asarray(Image.fromarray(depth_gt).resize(size, Image.NEAREST), dtype=np.uint16)
+
+        depth_path = self.depths_path + str(filename) + '.npz'
+        # load depth
+        f = np.load(depth_path)
+        depth_gt = f['depth'].T
+        f.close()
+        # resize depth
+        img_depth = depth_gt * 1000.0
+        img_depth_uint16 = img_depth.astype(np.uint16)
+        depth_gt = Image.fromarray(
+            img_depth_uint16).resize(size, Image.NEAREST)
+        return np.asarray(depth_gt, dtype=np.uint16)
+
+    def load_bbox_embed(self, idx_bbox_embed):
+        if self.embed_store is not None:
+            bbox, embedding = self.embed_store[idx_bbox_embed]
         else:
-            # set path
-            image_path = self.images_path + sample_path
             bbox_embed_path = self.bbox_embed_path + \
                 str(idx_bbox_embed) + '.npz'
-            # load & resize image
-            image = Image.open(image_path).resize(size, Image.BICUBIC)
-            # load bbox & embed
             f = np.load(bbox_embed_path)
             bbox = f['bbox']
-            # resize bbox
-            bbox = np.apply_along_axis(bbox_resize, 1, bbox)
             embedding = f['embed']
             f.close()
+        # resize bbox
+        bbox = self.geometry.resize_boxes(bbox)
+        return bbox, embedding
 
-            image = np.asarray(image, dtype=np.float32) / 255.0
-            bbox = np.asarray(bbox, dtype=np.float32)
-            embedding = np.asarray(embedding, dtype=np.float32)
-
-            if self.mode == 'online_eval':
-                depth_path = self.depths_path + str(filename) + '.npz'
-                has_valid_depth = False
-                try:
-                    # load depth
-                    f = np.load(depth_path)
-                    depth_gt = np.load(depth_path)['depth'].T
-                    f.close()
-                    # resize depth
-                    img_depth = depth_gt * 1000.0
-                    img_depth_uint16 = img_depth.astype(np.uint16)
-                    depth_gt = Image.fromarray(
-                        img_depth_uint16).resize(size, Image.NEAREST)
-                    has_valid_depth = True
-                except IOError:
-                    depth_gt = False
-                    # print('Missing gt for {}'.format(image_path))
-
-                if has_valid_depth:
-                    depth_gt = np.asarray(depth_gt, dtype=np.float32)
-                    depth_gt = np.expand_dims(depth_gt, axis=2)
-                    mask = np.zeros(depth_gt.shape, dtype=bool)
-                    mask[45:471, 41:601] = 1
-                    depth_gt = depth_gt / 1000.0
-                    mask &= depth_gt > .1
-
-                sample = {'image': image, 'depth': depth_gt, 'embedding': embedding,
-                          'bbox': bbox, 'mask': mask}
-            else:
-                sample = {'image': image, 'embedding': embedding, 'bbox': bbox}
-
-        if self.transform:
-            sample = self.transform(sample)
-
-        return sample
-
-    def rotate_image(self, image, angle, flag=Image.BILINEAR):
-        result = image.rotate(angle, resample=flag)
-        return result
-
-    def random_crop(self, img, depth, height, width):
-        assert img.shape[0] >= height
-        assert img.shape[1] >= width
-        assert img.shape[0] == depth.shape[0]
-        assert img.shape[1] == depth.shape[1]
-        x = random.randint(0, img.shape[1] - width)
-        y = random.randint(0, img.shape[0] - height)
-        img = img[y:y + height, x:x + width, :]
-        depth = depth[y:y + height, x:x + width, :]
-        return img, depth
-
-    def train_preprocess(self, image, depth_gt):
-        # Random flipping
+    def object_counts(self):
         '''
-        do_flip = random.random()
-        if do_flip > 0.5:
-            image = (image[:, ::-1, :]).copy()
-            depth_gt = (depth_gt[:, ::-1, :]).copy()
+        Return: Number of detected objects of every sample, from data.json when it records them, otherwise read
+                from the bbox arrays only
         '''
-        # Random gamma, brightness, color augmentation
-        do_augment = random.random()
-        if do_augment > 0.5:
-            image = self.augment_image(image)
-
-        return image, depth_gt
+        if self.idx_to_objects is not None:
+            return list(self.idx_to_objects)
+
+        counts = {}
+        for key in self.idx_to_bbox_embed:
+            if key in counts:
+                continue
+            if self.embed_store is not None:
+                counts[key] = self.embed_store.count(key)
+            else:
+                with np.load(self.bbox_embed_path + str(key) + '.npz') as f:
+                    counts[key] = len(f['bbox'])
 
-    def augment_image(self, image):
-        # gamma augmentation
-        gamma = random.uniform(0.9, 1.1)
-        image_aug = image ** gamma
+        return [counts[key] for key in self.idx_to_bbox_embed]
 
-        # brightness augmentation
-        brightness = random.uniform(0.75, 1.25)
+    def __getitem__(self, idx):
+        sample_path = self.filenames[idx]
+        idx_bbox_embed = self.idx_to_bbox_embed[idx]
 
-        image_aug = image_aug * brightness
+        image = self.load_image(sample_path)
+        bbox, embedding = self.load_bbox_embed(idx_bbox_embed)
+        depth_gt = None
 
-        # color augmentation
-        colors = np.random.uniform(0.9, 1.1, size=3)
-        white = np.ones((image.shape[0], image.shape[1]))
-        color_image = np.stack([white * colors[i] for i in range(3)], axis=2)
-        image_aug *= color_image
-        image_aug = np.clip(image_aug, 0, 1)
+        if self.mode != 'test':
+            try:
+                depth_gt = self.load_depth(sample_path)
+            except IOError:
+                if self.mode == 'train':
+                    raise
+                # print('Missing gt for {}'.format(image_path))
 
-        return image_aug
+        return build_sample(self.mode, image, depth_gt, bbox, embedding, self.transform, self.crop)
 
     def __len__(self):
         return len(self.filenames)
 
 
 class ToTensor(object):
-    def __init__(self, mode):
+    def __init__(self, mode, normalize=True):
         self.mode = mode
-        self.normalize = transforms.Normalize(
-            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        self.normalize = normalization() if normalize else None
 
     def __call__(self, sample):
         image = self.to_tensor(sample['image'])
-        image = self.normalize(image)
+        if self.normalize is not None:
+            image = self.normalize(image)
         embedding = torch.Tensor(sample['embedding'])
         bbox = torch.LongTensor(sample['bbox'])
 
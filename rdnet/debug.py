@@ -0,0 +1,61 @@
+import torch
+
+
+# Numerics checks read values back to the host, which synchronizes the device at every call,
+# so they are disabled unless explicitly turned on for debugging
+_check_numerics = False
+
+
+class NumericsError(RuntimeError):
+    pass
+
+
+def set_check_numerics(enabled):
+    global _check_numerics
+    _check_numerics = bool(enabled)
+
+
+def check_numerics_enabled():
+    return _check_numerics
+
+
+def _ensure_finite(stage, x):
+    bad = (~torch.isfinite(x)).sum().item()
+    if bad:
+        raise NumericsError('{}: {} non-finite values out of {}'.format(stage, bad, x.numel()))
+
+
+def check_finite(stage, x):
+    '''
+    Description: Raises NumericsError naming the stage when x holds NaN or infinite values, no-op unless enabled
+    '''
+    if _check_numerics:
+        _ensure_finite(stage, x.detach())
+
+
+def check_nonzero(stage, x, eps=1e-6):
+    '''
+    Description: Raises NumericsError naming the stage when x is non-finite or collapsed to zero, that is its
+                 squared norm is not above eps, no-op unless enabled
+    '''
+    if _check_numerics:
+        x = x.detach()
+        _ensure_finite(stage, x)
+        norm = (x.float() ** 2).sum().item()
+        if norm <= eps:
+            raise NumericsError('{}: degenerate values, squared norm {:.3e} <= {:.1e}'.format(stage, norm, eps))
+
+
+def check_min(stage, x, minimum, mask=None):
+    '''
+    Description: Raises NumericsError naming the stage when a value of x, or of its entries selected by mask,
+                 is not above minimum, no-op unless enabled
+    '''
+    if _check_numerics:
+        x = x.detach()
+        if mask is not None:
+            x = x[mask]
+        _ensure_finite(stage, x)
+        if x.numel() and x.min().item() <= minimum:
+            raise NumericsError('{}: {} values <= {:.1e}, min {:.3e}'.format(
+                stage, (x <= minimum).sum().item(), minimum, x.min().item()))
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+
+INDEX_FILE = 'index.json'
+BOXES_FILE = 'boxes.npy'
+EMBEDS_FILE = 'embeds.npy'
+OFFSETS_FILE = 'offsets.npy'
+
+
+def bbox_embed_keys(data_path):
+    '''
+    Description: Lists every distinct bbox_embed file referenced by the train and test splits of data.json,
+                 in order of first appearance
+    '''
+    with open(os.path.join(data_path, 'data.json')) as f:
+        d = json.load(f)
+
+    keys = []
+    for mode in ('train', 'test'):
+        keys.extend(d.get('idx_to_' + mode + '_bbox_embed', []))
+    return list(OrderedDict.fromkeys(keys))
+
+
+def pack_embed_store(data_path, output):
+    '''
+    Description: Consolidates the bbox_embed/<idx>.npz files into a single CSR-style store, the boxes and
+                 embeddings of all files are concatenated row-wise and offsets[k]:offsets[k + 1] gives the
+                 rows of the k-th file, so that a sample is served by slicing two memory-mapped arrays
+    Params:
+        - data_path: Root of the dataset holding data.json and the bbox_embed directory
+        - output: Directory receiving the store
+    Return: The index written next to the arrays
+    '''
+    keys = bbox_embed_keys(data_path)
+    paths = [os.path.join(data_path, 'bbox_embed', str(key) + '.npz') for key in keys]
+    os.makedirs(output, exist_ok=True)
+
+    # first pass only reads the small bbox arrays to size the outputs
+    counts = []
+    emb_size = 0
+    for path in tqdm(paths, desc='sizing'):
+        with np.load(path) as f:
+            counts.append(len(f['bbox']))
+            if not emb_size and counts[-1]:
+                emb_size = f['embed'].shape[1]
+
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    np.save(os.path.join(output, OFFSETS_FILE), offsets)
+
+    num_rows = int(offsets[-1])
+    boxes = open_memmap(os.path.join(output, BOXES_FILE), mode='w+', dtype=np.float32, shape=(num_rows, 4))
+    embeds = open_memmap(os.path.join(output, EMBEDS_FILE), mode='w+', dtype=np.float32,
+                         shape=(num_rows, emb_size))
+
+    for idx, path in enumerate(tqdm(paths, desc='packing')):
+        start, end = offsets[idx], offsets[idx + 1]
+        with np.load(path) as f:
+            boxes[start:end] = f['bbox']
+            embeds[start:end] = f['embed']
+
+    boxes.flush()
+    embeds.flush()
+    del boxes, embeds
+
+    index = {'keys': [str(key) for key in keys], 'emb_size': emb_size, 'num_rows': num_rows}
+    with open(os.path.join(output, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class EmbedStore(object):
+    '''
+    Description: Read-only view of a store written by pack_embed_store, returning the same (bbox, embed) pair
+                 as reading bbox_embed/<key>.npz. The arrays are memory-mapped so that every DataLoader worker
+                 shares the same pages of the OS cache instead of decompressing its own copy
+    Params:
+        - path: Directory of the store
+        - cache_mb: Size in megabytes of a per-process LRU keeping recently used entries resident,
+                    0 disables it and serves every entry straight from the memory map
+    '''
+
+    def __init__(self, path, cache_mb=0):
+        self.path = path
+        self.cache_bytes = int(cache_mb * 2 ** 20)
+
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.rows = {key: row for row, key in enumerate(index['keys'])}
+        self.emb_size = index['emb_size']
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+
+        # memmaps are opened lazily so that each DataLoader worker owns its own file handles
+        self.arrays = None
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    def open_arrays(self):
+        return {name: np.load(os.path.join(self.path, filename), mmap_mode='r')
+                for name, filename in (('boxes', BOXES_FILE), ('embeds', EMBEDS_FILE))}
+
+    def row(self, key):
+        try:
+            return self.rows[str(key)]
+        except KeyError:
+            raise KeyError('bbox_embed {} is not in the store at {}'.format(key, self.path))
+
+    def count(self, key):
+        row = self.row(key)
+        return int(self.offsets[row + 1] - self.offsets[row])
+
+    def read(self, key):
+        if self.arrays is None:
+            self.arrays = self.open_arrays()
+
+        row = self.row(key)
+        start, end = self.offsets[row:row + 2]
+        return self.arrays['boxes'][start:end], self.arrays['embeds'][start:end]
+
+    def __getitem__(self, key):
+        if not self.cache_bytes:
+            return self.read(key)
+
+        key = str(key)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        bbox, embed = (np.array(value) for value in self.read(key))
+        size = bbox.nbytes + embed.nbytes
+        if size <= self.cache_bytes:
+            self.cache[key] = (bbox, embed)
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_bytes:
+                _, (old_bbox, old_embed) = self.cache.popitem(last=False)
+                self.cached_bytes -= old_bbox.nbytes + old_embed.nbytes
+
+        return bbox, embed
+
+    def __contains__(self, key):
+        return str(key) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the bbox_embed files of a dataset into a memory-mapped store')
+    parser.add_argument('--data_path', required=True, help='dataset root holding data.json and bbox_embed')
+    parser.add_argument('--output', required=True, help='directory of the packed store')
+    opts = parser.parse_args()
+
+    index = pack_embed_store(opts.data_path, opts.output)
+    print('Packed {} bbox_embed files, {} objects, into {}'.format(
+        len(index['keys']), index['num_rows'], opts.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
+import math
+
 import torch
+import torch.distributed as dist
 from torch import nn
 from torch.nn import functional as F
 
@@ -7,6 +10,8 @@ import numpy as np
 from einops import rearrange, repeat
 from kornia import filters
 
+from debug import check_finite, check_min, check_nonzero
+
 
 def compute_errors(depths, preds, masks):
     errors = 0
@@ -60,24 +65,191 @@ def compute_errors(depths, preds, masks):
     return errors / cnt
 
 
+def masked_median(values, masks):
+    '''
+    Description: Median of the masked entries of every sample in batched calls, using NaN for the entries
+                 outside the mask. nanmedian returns the lower middle value of an even count, the upper one is
+                 the lower middle value of the negated entries, and both are averaged as by np.median
+    Params:
+        - values: Tensor with shape BxN
+        - masks: Boolean tensor with shape BxN
+    Return: Tensor with shape B, NaN for samples without any masked entry
+    '''
+    filled = torch.where(masks, values, torch.full_like(values, float('nan')))
+    lower = torch.nanmedian(filled, dim=1).values
+    upper = -torch.nanmedian(-filled, dim=1).values
+    return (lower + upper) / 2
+
+
+def masked_histogram_median(values, masks, low, high, bins=1024):
+    '''
+    Description: Approximate median of the masked entries of every sample from a log-spaced histogram, linear
+                 in the number of entries, the result is the center of the bin holding the median so its relative
+                 error is bounded by half a bin width, (log(high) - log(low)) / (2 * bins)
+    Params:
+        - values: Positive tensor with shape BxN, entries outside [low, high] fall into the extreme bins
+        - masks: Boolean tensor with shape BxN
+        - low, high: Range covered by the histogram
+        - bins: Number of bins
+    Return: Tensor with shape B, NaN for samples without any masked entry
+    '''
+    log_low, log_high = math.log(low), math.log(high)
+    width = (log_high - log_low) / bins
+
+    idxs = ((torch.log(values.clamp(low, high)) - log_low) / width).long().clamp(0, bins - 1)
+    counts = torch.zeros((values.shape[0], bins), dtype=values.dtype, device=values.device)
+    counts.scatter_add_(1, idxs, masks.to(values.dtype))
+
+    cumulative = counts.cumsum(dim=1)
+    median_bins = (cumulative < cumulative[:, -1:] / 2).sum(dim=1)
+    medians = torch.exp(log_low + (median_bins.to(values.dtype) + 0.5) * width)
+    return torch.where(cumulative[:, -1] > 0, medians, torch.full_like(medians, float('nan')))
+
+
+def compute_errors_batched(depths, preds, masks, median=masked_median):
+    '''
+    Description: Batched, device-resident version of compute_errors, every metric of every sample is computed
+                 at once through masked reductions instead of a Python loop over numpy arrays
+    Params:
+        - depths: Ground truth depths with shape Bx1xHxW
+        - preds: Predicted depths with shape Bx1xHxW
+        - masks: Boolean masks of the valid pixels with shape Bx1xHxW
+        - median: Function computing the per-sample masked medians used to scale the ground truth
+    Return:
+        - Sums over the samples of silog, abs_rel, log10, rms, sq_rel, log_rms, d1, d2, d3 as a tensor of 9
+        - Number of samples with at least one valid pixel, to accumulate across batches before averaging
+    '''
+    gt = depths.flatten(1).float()
+    pred = preds.flatten(1).float()
+    masks = masks.flatten(1)
+
+    valids = masks.sum(dim=1)
+    has_valid = valids > 0
+    weights = masks.float()
+    valids = valids.clamp(min=1)
+
+    def mean(values):
+        return (values * weights).sum(dim=1) / valids
+
+    scale = median(pred, masks) / median(gt, masks)
+    # pixels outside the masks are set to 1 so that they stay finite through logs and ratios
+    ones = torch.ones_like(gt)
+    gt = torch.where(masks, gt * scale.unsqueeze(1), ones)
+    pred = torch.where(masks, pred, ones)
+
+    thresh = torch.maximum(gt / pred, pred / gt)
+    d1 = mean((thresh < 1.25).float())
+    d2 = mean((thresh < 1.25 ** 2).float())
+    d3 = mean((thresh < 1.25 ** 3).float())
+
+    rms = torch.sqrt(mean((gt - pred) ** 2))
+
+    err = torch.log(pred) - torch.log(gt)
+    log_rms = torch.sqrt(mean(err ** 2))
+
+    abs_rel = mean(torch.abs(gt - pred) / gt)
+    sq_rel = mean(((gt - pred) ** 2) / gt)
+
+    silog = torch.sqrt((mean(err ** 2) - mean(err) ** 2).clamp(min=0)) * 100
+
+    log10 = mean(torch.abs(torch.log10(pred) - torch.log10(gt)))
+
+    errors = torch.stack([silog, abs_rel, log10, rms, sq_rel, log_rms, d1, d2, d3], dim=1)
+    errors = torch.where(has_valid.unsqueeze(1), errors, torch.zeros_like(errors))
+    return errors.sum(dim=0), has_valid.sum()
+
+
+class DepthMetrics(object):
+    '''
+    Description: Streaming accumulator of the evaluation metrics, batches are reduced on their device as they
+                 arrive so that neither predictions nor per-sample values are kept, and accumulators of several
+                 workers or processes can be merged before reading the averages
+    Params:
+        - median: 'exact' for masked_median, 'histogram' for the approximate masked_histogram_median
+        - min_depth, max_depth: Depth range covered by the histogram
+        - bins: Number of histogram bins
+        - device: Device holding the running sums
+    '''
+    names = ['loss', 'silog', 'abs_rel', 'log10', 'rms', 'sq_rel', 'log_rms', 'd1', 'd2', 'd3']
+
+    def __init__(self, median='exact', min_depth=1e-3, max_depth=80., bins=1024, device=None):
+        if median == 'exact':
+            self.median = masked_median
+        elif median == 'histogram':
+            self.median = lambda values, masks: masked_histogram_median(values, masks, min_depth, max_depth, bins)
+        else:
+            raise ValueError("median should be one of 'exact, histogram'. Got {}".format(median))
+
+        # running sums of the loss and metrics, followed by the number of samples
+        self.sums = torch.zeros(len(self.names) + 1, dtype=torch.float64, device=device)
+
+    def reset(self):
+        self.sums.zero_()
+
+    def update(self, depths, preds, masks, loss=None):
+        '''
+        Params:
+            - depths, preds, masks: Batch as taken by compute_errors_batched
+            - loss: Mean loss of the batch, weighted by the number of its samples
+        '''
+        measures, cnt = compute_errors_batched(depths, preds, masks, median=self.median)
+        self.sums = self.sums.to(measures.device)
+        if loss is not None:
+            self.sums[0] += loss.detach().double() * cnt
+        self.sums[1:-1] += measures.double()
+        self.sums[-1] += cnt
+
+    def merge(self, other):
+        self.sums += other.sums.to(self.sums.device)
+        return self
+
+    def all_reduce(self):
+        if dist.is_initialized():
+            dist.all_reduce(self.sums, op=dist.ReduceOp.SUM)
+        return self
+
+    @property
+    def count(self):
+        return int(self.sums[-1].item())
+
+    def compute(self):
+        '''
+        Return: Numpy array with the averages of the loss and metrics in the order of names
+        '''
+        sums = self.sums.cpu().numpy()
+        return sums[:-1] / max(sums[-1], 1)
+
+
 def compute_ssi(preds, targets, masks, trimmed=1., eps=1e-4):
+    '''
+    Description: Trimmed mean absolute error, the largest 1 - trimmed fraction of the valid errors of each sample
+                 is discarded and the rest is summed and divided by the number of valid pixels. The cutoff comes
+                 from topk over at most (1 - trimmed) of the pixels instead of sorting every error
+    Params:
+        - preds, targets: Aligned predictions and targets with shape BxCxHxW
+        - masks: Boolean masks of the valid pixels with shape BxCxHxW
+        - trimmed: Fraction of the valid errors that are kept
+    Return: Tensor with shape BxC
+    '''
     masks = rearrange(masks, 'b c h w -> b c (h w)')
     errors = rearrange(torch.abs(preds - targets), 'b c h w -> b c (h w)')
-    b, _, n = masks.shape
+    n = errors.shape[2]
     valids = masks.sum(2, True)
-    invalids = (~masks).sum(2, True)
+    kept_sum = (errors * masks).sum(2, True)
 
-    errors -= (errors + eps) * (~masks)
-    sorted_errors, _ = torch.sort(errors, dim=2)
-    assert torch.isnan(sorted_errors).sum() == 0
-    idxs = repeat(torch.arange(end=n, device=valids.device),
-                  'n -> b c n', b=b, c=1)
-    cutoff = (trimmed * valids) + invalids
-    trimmed_errors = torch.where((invalids <= idxs) & (
-        idxs < cutoff), sorted_errors, sorted_errors - sorted_errors)
+    drops = valids - torch.ceil(trimmed * valids).long()
+    num_top = min(int(math.ceil((1 - trimmed) * n)), n)
+    if num_top > 0:
+        # the cutoff of each sample is its drops-th largest valid error, invalid pixels never reach the top
+        top_errors = torch.topk(errors.masked_fill(~masks, -float('inf')), num_top, dim=2).values
+        cutoffs = torch.gather(top_errors, 2, (drops - 1).clamp(min=0))
+        below = masks & (errors < cutoffs)
+        # errors equal to the cutoff fill the remaining kept slots
+        trimmed_sum = (errors * below).sum(2, True) + (valids - drops - below.sum(2, True)) * cutoffs
+        kept_sum = torch.where(drops > 0, trimmed_sum, kept_sum)
 
-    assert torch.isnan(trimmed_errors).sum() == 0
-    return (trimmed_errors / valids).sum(dim=2)
+    check_finite('compute_ssi trimmed errors', kept_sum)
+    return (kept_sum / valids).squeeze(2)
 
 
 def compute_reg(preds, targets, masks, num_scale=4):
@@ -107,34 +279,25 @@ def compute_loss(preds, targets, masks, trimmed=1., num_scale=4, alpha=.5, eps=1
     def align(imgs, masks):
         patches = rearrange(imgs, 'b c h w -> b c (h w)')
         patched_masks = rearrange(masks, 'b c h w -> b c (h w)')
-        meds = []
 
-        for img, mask in zip(imgs, masks):
-            med = torch.masked_select(img, mask).median(0, True)[0]
-            meds.append(med.unsqueeze(1))
+        # one median over every channel of each sample, for the whole batch at once
+        meds = masked_median(rearrange(patches, 'b c p -> b (c p)'),
+                             rearrange(patched_masks, 'b c p -> b (c p)'))
 
-        t = repeat(torch.cat(meds), 'b c -> b c d', d=1)
-        masked_abs = torch.abs(patches - t) * patched_masks
-        assert torch.isnan(masked_abs).sum() == 0
+        t = repeat(meds, 'b -> b c d', c=1, d=1)
+        masked_abs = torch.where(patched_masks, torch.abs(patches - t), torch.zeros_like(patches))
+        check_finite('compute_loss align masked absolute deviation', masked_abs)
 
         s = masked_abs.sum(2, True) / patched_masks.sum(2, True) + eps
-        try:
-            assert 0 not in s
-        except:
-            print("Masked absolute: ", masked_abs[s[:, :, 0] < eps])
-            print("Patches: ", patches[s[:, :, 0] < eps])
-            assert False
-        assert torch.isnan(s).sum() == 0
-        temp = (imgs - t.unsqueeze(3)) / s.unsqueeze(3)
-        assert torch.isnan(temp).sum() == 0
+        check_min('compute_loss align scale', s, 0)
 
         return (imgs - t.unsqueeze(3)) / s.unsqueeze(3)
 
-    assert (preds * preds).sum() > eps
+    check_nonzero('compute_loss predictions', preds, eps)
     aligned_preds = align(preds, masks)
     aligned_targets = align(targets, masks)
-    assert torch.isnan(aligned_preds).sum() == 0
-    assert torch.isnan(aligned_targets).sum() == 0
+    check_finite('compute_loss aligned predictions', aligned_preds)
+    check_finite('compute_loss aligned targets', aligned_targets)
 
     # loss = compute_ssi(aligned_preds, aligned_targets, masks, trimmed) / 2
     # assert torch.isnan(loss).sum() == 0
@@ -142,7 +305,7 @@ def compute_loss(preds, targets, masks, trimmed=1., num_scale=4, alpha=.5, eps=1
     if alpha > 0.:
         loss += alpha * compute_reg(aligned_preds, aligned_targets,
                                     masks, num_scale)
-    assert torch.isnan(loss).sum() == 0
+    check_finite('compute_loss loss', loss)
     return loss.mean()
 
 class silog_loss(nn.Module):
@@ -151,23 +314,37 @@ class silog_loss(nn.Module):
         self.variance_focus = variance_focus
         self.num_scale = num_scale
 
-    def silog(self, depth_est, depth_gt, mask):
-        d = torch.log(depth_est[mask]) - torch.log(depth_gt[mask])
-        return torch.sqrt((d ** 2).mean() - self.variance_focus * (d.mean() ** 2))
+    def silog(self, diffs, weights):
+        '''
+        Params:
+            - diffs: Log differences between estimated and ground truth depths, zero outside the masks
+            - weights: Masks as floats
+        Return: Scale-invariant log error over the masked pixels, from weighted sums only
+        '''
+        count = weights.sum()
+        mean = (diffs * weights).sum() / count
+        mean_sq = (diffs * diffs * weights).sum() / count
+        return torch.sqrt(mean_sq - self.variance_focus * (mean ** 2))
 
     def forward(self, preds, targets, masks):
+        # logs of mixed precision predictions lose too much accuracy, the loss is always computed in fp32
+        with torch.autocast(device_type=preds.device.type, enabled=False):
+            return self.multi_scale(preds.float(), targets.float(), masks)
+
+    def multi_scale(self, preds, targets, masks):
         total = 0
         step = 1
 
-        try:
-            assert preds[masks].min() > 1e-6
-        except:
-            print(preds[masks].min())
-            assert False
+        check_min('silog_loss predictions', preds, 1e-6, masks)
+
+        # the log difference is computed once at full resolution with static shapes, pixels outside the masks
+        # are replaced by 1 before the logs so that neither values nor gradients can become NaN there
+        ones = torch.ones_like(preds)
+        diffs = torch.log(torch.where(masks, preds, ones)) - torch.log(torch.where(masks, targets, ones))
+        weights = masks.to(preds.dtype)
 
         for scale in range(self.num_scale):
-            total += self.silog(preds[:, :, ::step, ::step],
-                                targets[:, :, ::step, ::step], masks[:, :, ::step, ::step])
+            total += self.silog(diffs[:, :, ::step, ::step], weights[:, :, ::step, ::step])
             step *= 2
 
-        return total / self.num_scale
\ No newline at end of file
+        return total / self.num_scale
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+# crop of Eigen et al. as (top, bottom, left, right) rows and columns of the 480x640 NYU frames
+EIGEN_CROP = (45, 471, 41, 601)
+EIGEN_SOURCE_SIZE = (480, 640)
+
+
+class Geometry(object):
+    '''
+    Description: Maps the coordinates of the source frames, in which the detector boxes are given, to the training
+                 resolution, so that the resize target, the boxes and the evaluation crop always agree with
+                 image_size instead of being hard-coded for one resolution
+    Params:
+        - image_size: (height, width) of the images fed to the model
+        - source_size: (height, width) of the frames of the dataset
+    '''
+
+    def __init__(self, image_size, source_size=EIGEN_SOURCE_SIZE):
+        self.height, self.width = int(image_size[0]), int(image_size[1])
+        self.source_height, self.source_width = int(source_size[0]), int(source_size[1])
+        self.y_scale = self.height / self.source_height
+        self.x_scale = self.width / self.source_width
+
+    @property
+    def size(self):
+        '''
+        Return: The (width, height) target of PIL resizes
+        '''
+        return (self.width, self.height)
+
+    def resize_boxes(self, boxes):
+        '''
+        Params: Boxes with shape Nx4 holding (x, y, xmax, ymax) in pixels of the source frames, x being horizontal
+        Return: The boxes in pixels of the training resolution, rounded to integers
+        '''
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scale = np.array([self.x_scale, self.y_scale, self.x_scale, self.y_scale])
+        return np.round(boxes * scale).astype(np.int64)
+
+    def crop(self, crop=EIGEN_CROP, crop_size=EIGEN_SOURCE_SIZE):
+        '''
+        Params:
+            - crop: (top, bottom, left, right) region of frames of crop_size
+            - crop_size: (height, width) of the frames the crop is defined on
+        Return: The region rescaled to the training resolution and clipped to it
+        '''
+        top, bottom, left, right = crop
+        y_scale = self.height / crop_size[0]
+        x_scale = self.width / crop_size[1]
+        top, bottom = (min(max(int(round(value * y_scale)), 0), self.height) for value in (top, bottom))
+        left, right = (min(max(int(round(value * x_scale)), 0), self.width) for value in (left, right))
+        return top, bottom, left, right
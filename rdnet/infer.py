@@ -0,0 +1,143 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from tqdm import tqdm
+
+from args import Arg_train
+from geometry import Geometry
+from model import build_model
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_state_dict(checkpoint_path):
+    '''
+    Description: Reads the model weights of a checkpoint written by main_worker, dropping the 'module.' prefix
+                 added by DataParallel so that they load into a bare RDNet
+    '''
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    state_dict = checkpoint['model'] if 'model' in checkpoint else checkpoint
+
+    prefix = 'module.'
+    return {(key[len(prefix):] if key.startswith(prefix) else key): value
+            for key, value in state_dict.items()}
+
+
+class DepthPredictor(object):
+    '''
+    Description: Wraps a trained RDNet for inference on CPU or GPU without going through the training script
+    Params:
+        - checkpoint_path: Checkpoint saved by main_worker, or a bare state dict
+        - args: Arg_train instance describing the architecture, read from train_arg.txt when not given
+        - device: Device to run on, defaults to the first GPU if any, else CPU
+    '''
+
+    def __init__(self, checkpoint_path, args=None, device=None):
+        self.args = args if args is not None else Arg_train()
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+        self.model = build_model(self.args)
+        self.model.load_state_dict(load_state_dict(checkpoint_path))
+        self.model.to(self.device)
+        self.model.eval()
+
+        self.normalize = transforms.Normalize(
+            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+    def to_tensor(self, value, dtype):
+        if isinstance(value, np.ndarray):
+            value = torch.from_numpy(np.ascontiguousarray(value))
+        return value.to(self.device, dtype)
+
+    def predict(self, images, embeddings, boxes, objects=None):
+        '''
+        Params:
+            - images: Batch of images resized to image_size, either a BxHxWx3 numpy array or a Bx3xHxW tensor,
+                      with values in [0, 1] or uint8 in [0, 255]
+            - embeddings: Batch of detector embeddings with shape BxNxC
+            - boxes: Batch of boxes with shape BxNx4, already rescaled to image_size
+            - objects: Optional BxN masks of the real objects when embeddings and boxes are padded
+        Return: Depth in meters clipped to [min_depth_eval, max_depth_eval], a BxHxW numpy array for numpy
+                images, else a Bx1xHxW tensor on the predictor device
+        '''
+        is_numpy = isinstance(images, np.ndarray)
+        if is_numpy:
+            images = images.transpose((0, 3, 1, 2))
+
+        is_uint8 = images.dtype in (np.uint8, torch.uint8)
+        images = self.to_tensor(images, torch.float32)
+        if is_uint8:
+            images = images / 255.0
+        images = self.normalize(images)
+        embeddings = self.to_tensor(embeddings, torch.float32)
+        boxes = self.to_tensor(boxes, torch.long)
+        if objects is not None:
+            objects = self.to_tensor(objects, torch.bool)
+
+        with torch.no_grad():
+            disp_est = self.model(images, embeddings, boxes, objects)
+
+        depth = (1. / disp_est).clamp(self.args.min_depth_eval, self.args.max_depth_eval)
+        if is_numpy:
+            return depth[:, 0].cpu().numpy()
+        return depth
+
+
+def load_sample(args, image_path):
+    '''
+    Description: Reads an image and its detector output stored next to it as <name>.npz with the 'bbox' and
+                 'embed' arrays of bbox_embed, boxes being in the original image resolution
+    '''
+    geometry = Geometry(args.image_size, args.source_size)
+    image = np.asarray(Image.open(image_path).convert('RGB').resize(geometry.size, Image.BICUBIC), dtype=np.uint8)
+
+    f = np.load(os.path.splitext(image_path)[0] + '.npz')
+    bbox = geometry.resize_boxes(f['bbox'])
+    embedding = np.asarray(f['embed'], dtype=np.float32)
+    f.close()
+
+    return image, embedding, np.asarray(bbox, dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict depth for every image of a directory')
+    parser.add_argument('--checkpoint', required=True, help='checkpoint saved by train.py')
+    parser.add_argument('--input_dir', required=True,
+                        help='directory of images, each with a <name>.npz holding its bbox and embed')
+    parser.add_argument('--output_dir', required=True, help='directory receiving one <name>.npy depth per image')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--device', default=None, help='cpu, cuda or cuda:<index>')
+    opts = parser.parse_args()
+
+    predictor = DepthPredictor(opts.checkpoint, device=opts.device)
+    os.makedirs(opts.output_dir, exist_ok=True)
+
+    names = sorted(name for name in os.listdir(opts.input_dir)
+                   if name.lower().endswith(IMAGE_EXTENSIONS))
+    samples = [(name, load_sample(predictor.args, os.path.join(opts.input_dir, name)))
+               for name in tqdm(names, desc='loading')]
+
+    # images are batched by number of detections since a batch needs a common object count
+    groups = {}
+    for name, sample in samples:
+        groups.setdefault(len(sample[2]), []).append((name, sample))
+
+    for group in tqdm(list(groups.values()), desc='predicting'):
+        for start in range(0, len(group), opts.batch_size):
+            batch = group[start:start + opts.batch_size]
+            images, embeddings, boxes = (np.stack(arrays) for arrays in zip(*[sample for _, sample in batch]))
+            depths = predictor.predict(images, embeddings, boxes)
+
+            for (name, _), depth in zip(batch, depths):
+                np.save(os.path.join(opts.output_dir, os.path.splitext(name)[0] + '.npy'), depth)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,41 @@ from torch.nn import functional as F
 
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
-from blocks import InjectionBlock, ScratchBlock, ReassembleBlock, RefineBlock, Interpolate
+from blocks import InjectionBlock, ScratchBlock, ReassembleBlock, RefineBlock, Interpolate, pack_tokens
 from kornia import filters
 
+from debug import check_nonzero
+
+
+def patch_boxes(locations, patch_size):
+    '''
+    Description: Converts boxes in pixels to the patches they overlap, every box covering at least one patch
+    Params:
+        - locations: Boxes with shape BxNx4 holding (x, y, xmax, ymax) in pixels, x being horizontal
+        - patch_size: Side of the square patches in pixels
+    Return: Boxes with shape BxNx4 holding (x, y, xmax, ymax) in patches, xmax and ymax being exclusive
+    '''
+    start = torch.div(locations[..., :2], patch_size, rounding_mode='floor')
+    end = -torch.div(-locations[..., 2:], patch_size, rounding_mode='floor')
+    return torch.cat([start, torch.maximum(end, start + 1)], dim=-1)
+
+
+def box_masks(locs, height, width):
+    '''
+    Description: Builds the masks of every box in a single broadcasted comparison between the grid coordinates
+                 and the box corners, equivalent to setting masks[..., y:ymax, x:xmax] = True for each box
+    Params:
+        - locs: Boxes with shape BxNx4 holding (x, y, xmax, ymax) indices into the grid, x along its columns
+        - height: Number of rows of the grid, indexed by y
+        - width: Number of columns of the grid, indexed by x
+    Return: Boolean masks with shape BxNxHxW
+    '''
+    rows = torch.arange(height, device=locs.device)
+    cols = torch.arange(width, device=locs.device)
+    in_rows = (rows >= locs[..., 1:2]) & (rows < locs[..., 3:4])
+    in_cols = (cols >= locs[..., 0:1]) & (cols < locs[..., 2:3])
+    return in_rows.unsqueeze(-1) & in_cols.unsqueeze(-2)
+
 
 class KnowledgeFusion(nn.Module):
     '''
@@ -18,11 +50,15 @@ class KnowledgeFusion(nn.Module):
         - max_patches: Maximum number of patches for each of the input image
         - patch_dim: Dimension of each input patch
         - patch_size: the one-sided dimension of initial patch used to compute the normalized locations of objects
+        - sparse_objects: Only feed each object the patches inside its box instead of a copy of every patch,
+                          so that memory and compute scale with the box areas rather than the number of objects,
+                          the patches of an object then only attend to each other as with mask_attention
     '''
 
-    def __init__(self, emb_size, dims, max_patches, patch_dim, patch_size, **kwargs):
+    def __init__(self, emb_size, dims, max_patches, patch_dim, patch_size, sparse_objects=False, **kwargs):
         super().__init__()
         self.patch_size = patch_size
+        self.sparse_objects = sparse_objects
         layers = [InjectionBlock(
             emb_size=emb_size, inp_dim=patch_dim, out_dim=dims[0], max_patches=max_patches, **kwargs)]
 
@@ -32,46 +68,96 @@ class KnowledgeFusion(nn.Module):
 
         self.layers = nn.ModuleList(layers)
 
-    def patching(self, locations, patch_size):
-        locs = locations
-        locs[:, :, :2] -= locs[:, :, :2] % patch_size
-        locs[:, :, 2:] += (patch_size - locs[:, :, 2:] % patch_size)
-        return locs
-
-    def forward(self, patches, embs, locations):
+    def forward(self, patches, embs, locations, objects=None):
         '''
         Params:
             - patches: Input image patches as flatten
             - embs: Embedding tensors of multiple objects for each of the input image
-            - locations: Locations of objects inside each image associated with embs
+            - locations: Boxes of the objects associated with embs, (x, y, xmax, ymax) in pixels of the image
+            - objects: Masks with shape BxN marking the real objects of a batch padded by pad_collate,
+                       the padded ones are skipped by every InjectionBlock, None when nothing is padded
         Return: A latent patches represent the information of each image after the fusion with prior knowledge
         '''
-        embs = torch.cat([embs, embs.mean(1, True)], dim=1)
+        if objects is None:
+            embs = torch.cat([embs, embs.mean(1, True)], dim=1)
+        else:
+            weights = objects.unsqueeze(2).to(embs.dtype)
+            img_embs = (embs * weights).sum(1, True) / weights.sum(1, True).clamp(min=1)
+            embs = torch.cat([embs, img_embs], dim=1)
+            objects = torch.cat([objects, torch.ones_like(objects[:, :1])], dim=1)
         b, n, _ = embs.shape
 
-        locs = self.patching(locations, patch_size=self.patch_size)
-        masks = torch.zeros(patches.shape[:3], dtype=torch.bool).to(embs.device)
-        masks = repeat(masks, 'b h w -> b n h w', n=n)
+        locs = patch_boxes(locations, patch_size=self.patch_size)
 
-        img_loc = torch.LongTensor([0, 0, patches.shape[1], patches.shape[2]]).to(locs.device)
+        img_loc = torch.LongTensor([0, 0, patches.shape[2], patches.shape[1]]).to(locs.device)
         img_locs = repeat(img_loc, 'd -> b n d', b=b, n=1)
         locs = torch.cat([locs, img_locs], dim=1)
 
-        for idx, loc in enumerate(locs):
-            for jdx, obj_loc in enumerate(loc):
-                masks[idx, jdx, obj_loc[0]:obj_loc[2],
-                      obj_loc[1]:obj_loc[3]] = True
+        masks = box_masks(locs, patches.shape[1], patches.shape[2])
+        if objects is not None:
+            masks = masks & objects[:, :, None, None]
+        if self.sparse_objects:
+            return self.sparse_forward(patches, embs, masks, objects)
 
         masks = rearrange(masks, 'b n h w -> (b n) (h w)')
         patches = repeat(patches, 'b h w d -> b n (h w) d', n=n)
 
         for layer in self.layers:
-            patches, embs = layer(patches, embs, masks)
+            patches, embs = layer(patches, embs, masks, objects)
 
         masks = repeat(masks, '(b n) p -> b n p c', n=n, c=1)
         result = (patches * masks).sum(dim=1) / masks.sum(dim=1)
         return result
 
+    def sparse_forward(self, patches, embs, masks, objects=None):
+        '''
+        Params:
+            - patches: Input image patches with shape BxHxWxD
+            - embs: Embeddings with shape BxNxC, the last one belongs to the whole image
+            - masks: Box masks with shape BxNxHxW as built by box_masks
+            - objects: Masks with shape BxN, False for the padded objects which are dropped before packing
+        Return: Same as forward, computed by running every object only over the patches inside its box
+        '''
+        b, n = masks.shape[:2]
+        patches = rearrange(patches, 'b h w d -> b (h w) d')
+        masks = rearrange(masks, 'b n h w -> b n (h w)')
+        p = patches.shape[1]
+
+        # the last object spans the whole image and keeps the dense path, the boxes are packed
+        obj_masks = rearrange(masks[:, :-1], 'b n p -> (b n) p')
+        batch_index = repeat(torch.arange(b, device=patches.device), 'b -> (b n) k', n=n - 1, k=1)
+        keep = None if objects is None else objects[:, :-1].flatten()
+        if keep is not None:
+            obj_masks, batch_index = obj_masks[keep], batch_index[keep]
+
+        index, valid = pack_tokens(obj_masks)
+        obj_patches = patches[batch_index, index]
+        img_masks = torch.ones((b, p), dtype=torch.bool).to(masks.device)
+
+        for layer in self.layers:
+            x = layer.relate(embs, objects)
+            obj_x = rearrange(x[:, :-1], 'b n d -> (b n) d')
+            obj_patches, obj_embs = layer.inject(
+                obj_patches, obj_x if keep is None else obj_x[keep], valid, index)
+            if keep is not None:
+                kept_embs = obj_embs
+                obj_embs = kept_embs.new_zeros((len(keep), kept_embs.shape[1]))
+                obj_embs[keep] = kept_embs
+            patches, img_embs = layer.inject(patches, x[:, -1], img_masks)
+            embs = torch.cat([rearrange(obj_embs, '(b n) d -> b n d', b=b), img_embs.unsqueeze(1)], dim=1)
+
+        # scatter the packed patches back and average every patch over the objects covering it
+        d = patches.shape[-1]
+        flat_index = (batch_index * p + index).flatten()
+        weights = valid.to(patches.dtype)
+        total = patches.reshape(b * p, d).index_add(
+            0, flat_index, (obj_patches * weights.unsqueeze(2)).reshape(-1, d))
+        counts = torch.ones(b * p, dtype=patches.dtype, device=patches.device).index_add(
+            0, flat_index, weights.flatten())
+
+        result = total / counts.unsqueeze(1)
+        return rearrange(result, '(b p) d -> b p d', b=b)
+
 
 class DensePrediction(nn.Module):
     '''
@@ -178,21 +264,22 @@ class RDNet(nn.Module):
             activation(True)
         )
 
-    def forward(self, images, embs, locations):
+    def forward(self, images, embs, locations, objects=None):
         '''
         Params:
             - images: A batch of multiple input images
             - embs: A batch of multiple embedding matrices as genereted by visual detector
             - locations: A batch of multiple locations associated with each of the embedding in embs
+            - objects: Optional BxN masks of the real objects when embs and locations were padded by pad_collate
         Return: Final depth estimation for each images in the input batch
         '''
-        assert (images * images).sum() > 1e-6
+        check_nonzero('RDNet input images', images)
         patches = self.to_patch(images)
-        assert (patches * patches).sum() > 1e-6
-        patches = self.knowledge(patches, embs, locations)
-        assert (patches * patches).sum() > 1e-6
+        check_nonzero('RDNet to_patch', patches)
+        patches = self.knowledge(patches, embs, locations, objects)
+        check_nonzero('RDNet KnowledgeFusion', patches)
         results = self.dense(patches)
-        assert (results * results).sum() > 1e-6
+        check_nonzero('RDNet DensePrediction', results)
         inv_depth = self.head(results)
         # try:
         #     assert (inv_depth ** 2).sum() > 1e-6
@@ -200,24 +287,52 @@ class RDNet(nn.Module):
         #     print(inv_depth)
         #     assert False
 
-        if self.invert:
-            try:
-                depth = self.scale * inv_depth + self.shift
-            except:
-                print(self.scale, self.shift)
-                print(inv_depth.shape)
-                assert False
-                
-            depth[depth < 1e-8] = 1e-8
-            depth = 1.0 / depth
-        else:
-            depth = inv_depth
+        # the inversion and the output activation stay in fp32 under mixed precision
+        with torch.autocast(device_type=inv_depth.device.type, enabled=False):
+            inv_depth = inv_depth.float()
 
-        depth = F.interpolate(
-            depth,
-            size=images.shape[2:4],
-            mode="bilinear",
-            align_corners=False
-        )
+            if self.invert:
+                try:
+                    depth = self.scale * inv_depth + self.shift
+                except:
+                    print(self.scale, self.shift)
+                    print(inv_depth.shape)
+                    assert False
+                    
+                depth[depth < 1e-8] = 1e-8
+                depth = 1.0 / depth
+            else:
+                depth = inv_depth
+
+            depth = F.interpolate(
+                depth,
+                size=images.shape[2:4],
+                mode="bilinear",
+                align_corners=False
+            )
+
+            return F.softplus(depth)
 
-        return F.softplus(depth)
+
+def build_model(args):
+    '''
+    Description: Creates the RDNet described by an Arg_train instance, shared by training and inference so that
+                 checkpoints always match the architecture they are loaded into
+    '''
+    return RDNet(image_size=args.image_size,
+                 patch_size=args.patch_size,
+                 knowledge_dims=args.knowledge_dims,
+                 dense_dims=args.dense_dims,
+                 latent_dim=args.latent_dims,
+                 data_path=args.data_path,
+                 emb_size=args.emb_size,
+                 use_readout=args.use_readout,
+                 hooks=args.hooks,
+                 activation=args.activation,
+                 landmarks=args.landmarks,
+                 sparse_objects=args.sparse_objects,
+                 mask_attention=args.mask_attention,
+                 scale=args.scale,
+                 shift=args.shift,
+                 invert=args.invert,
+                 transformer=args.transformer)
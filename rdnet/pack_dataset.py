@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MODES = ('train', 'test')
+# depths are stored in millimeters
+MAX_DEPTH = np.iinfo(np.uint16).max / 1000.0
+
+
+def checksum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_samples(input_path, mode):
+    '''
+    Description: Lists the (name, image, depth, bbox_embed, transposed) sources of a split, either from a dataset in
+                 the layout read by DataLoadPreprocess, found through its data.json, or from a directory <mode>
+                 holding <name>.jpg|png images with their detections in <name>.npz, as read by infer.py, and their
+                 depths in meters in <name>_depth.npy or the 'depth' array of <name>_depth.npz
+    '''
+    data_json = os.path.join(input_path, 'data.json')
+    if os.path.exists(data_json):
+        with open(data_json) as f:
+            d = json.load(f)
+        samples = []
+        for name, key in zip(d['idx_to_' + mode + '_files'], d['idx_to_' + mode + '_bbox_embed']):
+            samples.append((name,
+                            os.path.join(input_path, 'nyu_' + mode, name),
+                            os.path.join(input_path, 'nyu_depth_' + mode, '{}.npz'.format(int(name[:-4]))),
+                            os.path.join(input_path, 'bbox_embed', '{}.npz'.format(key)),
+                            True))
+        return samples
+
+    split = os.path.join(input_path, mode)
+    if not os.path.isdir(split):
+        return []
+    samples = []
+    for name in sorted(os.listdir(split)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        depth = os.path.join(split, stem + '_depth.npy')
+        if not os.path.exists(depth):
+            depth = os.path.join(split, stem + '_depth.npz')
+        samples.append((name, os.path.join(split, name), depth, os.path.join(split, stem + '.npz'), False))
+    return samples
+
+
+def read_depth(path, transposed):
+    if path.endswith('.npy'):
+        depth = np.load(path)
+    else:
+        with np.load(path) as f:
+            depth = f['depth']
+    return depth.T if transposed else depth
+
+
+def pack_sample(task):
+    '''
+    Description: Validates the image, depth and detections of one sample then writes them resized to image_size,
+                 nothing being written for an invalid sample
+    Return: Dictionary with the error of an invalid sample, or its object count, embedding size and the
+            checksums of the written files
+    '''
+    (mode, source, output, image_name, key, image_size, source_size, image_format, depth_required) = task
+    name, image_path, depth_path, bbox_embed_path, transposed = source
+    height, width = image_size
+
+    try:
+        with Image.open(image_path) as image:
+            image.load()
+            if image.size != (source_size[1], source_size[0]):
+                raise ValueError('image is {}x{}, expected {}x{}'.format(
+                    image.size[1], image.size[0], source_size[0], source_size[1]))
+            image = image.convert('RGB').resize((width, height), Image.BICUBIC)
+
+        depth = None
+        if os.path.exists(depth_path):
+            depth = read_depth(depth_path, transposed)
+            if depth.shape != tuple(source_size):
+                raise ValueError('depth is {}, expected {}'.format(depth.shape, tuple(source_size)))
+            if not np.isfinite(depth).all() or depth.min() < 0 or depth.max() > MAX_DEPTH:
+                raise ValueError('depth is not finite or outside [0, {:.3f}] meters'.format(MAX_DEPTH))
+            # same conversion as DataLoadPreprocess.load_depth
+            depth = (depth * 1000.0).astype(np.uint16)
+            depth = np.asarray(Image.fromarray(depth).resize((width, height), Image.NEAREST), dtype=np.uint16)
+        elif depth_required:
+            raise ValueError('missing depth {}'.format(depth_path))
+
+        with np.load(bbox_embed_path) as f:
+            bbox = np.asarray(f['bbox'])
+            embed = np.asarray(f['embed'], dtype=np.float32)
+        if bbox.ndim != 2 or bbox.shape[1] != 4 or embed.ndim != 2 or len(bbox) != len(embed):
+            raise ValueError('bbox {} and embed {} do not describe the same objects'.format(bbox.shape, embed.shape))
+        if not np.isfinite(bbox).all() or not np.isfinite(embed).all():
+            raise ValueError('bbox or embed is not finite')
+        limit = np.array([source_size[1], source_size[0]] * 2)
+        if (bbox < 0).any() or (bbox > limit).any() or (bbox[:, :2] > bbox[:, 2:]).any():
+            raise ValueError('bbox outside of the image or with negative size')
+    except Exception as error:
+        return {'name': name, 'error': '{}: {}'.format(type(error).__name__, error)}
+
+    files = {}
+    path = os.path.join('nyu_' + mode, image_name)
+    image.save(os.path.join(output, path), **({'quality': 95} if image_format == 'jpg' else {}))
+    files[path] = None
+    if depth is not None:
+        path = os.path.join('nyu_depth_' + mode, '{}.npy'.format(int(image_name[:-4])))
+        np.save(os.path.join(output, path), depth)
+        files[path] = None
+    path = os.path.join('bbox_embed', '{}.npz'.format(key))
+    np.savez(os.path.join(output, path), bbox=bbox, embed=embed)
+    files[path] = None
+
+    return {'name': name, 'objects': len(bbox), 'emb_size': embed.shape[1], 'has_depth': depth is not None,
+            'checksums': {path: checksum(os.path.join(output, path)) for path in files}}
+
+
+def pack_dataset(input_path, output, image_size, source_size, workers=None, image_format='png', strict=False):
+    '''
+    Description: Writes a dataset in the layout read by DataLoadPreprocess, with images already resized to
+                 image_size, depths as uncompressed uint16 millimeters resized alike, and uncompressed detections.
+                 Every sample is validated and packed by a process pool, and data.json records the object count
+                 of every sample and the checksum of every file, data.json being written last
+    Params:
+        - input_path: Raw dataset, see list_samples for the accepted layouts
+        - output: Directory of the packed dataset
+        - image_size: (height, width) of the packed images and depths
+        - source_size: (height, width) of the raw images and depths, in which the boxes are given and kept
+        - workers: Number of processes, defaults to the number of cores
+        - image_format: png to keep the resized images lossless, jpg for smaller files
+        - strict: Raise on the first invalid sample instead of leaving it out of data.json
+    Return: The content of data.json and the list of (mode, name, error) of the invalid samples
+    '''
+    for directory in ['bbox_embed'] + ['nyu_' + mode for mode in MODES] + ['nyu_depth_' + mode for mode in MODES]:
+        os.makedirs(os.path.join(output, directory), exist_ok=True)
+
+    tasks, key = [], 0
+    for mode in MODES:
+        for idx, source in enumerate(list_samples(input_path, mode)):
+            image_name = '{}.{}'.format(idx + 1, image_format)
+            tasks.append((mode, source, output, image_name, key, tuple(image_size), tuple(source_size),
+                          image_format, mode == 'train'))
+            key += 1
+
+    d = {'image_size': list(image_size), 'source_size': list(source_size), 'depth_format': 'uint16',
+         'checksums': {}}
+    for mode in MODES:
+        d.update({'idx_to_' + mode + '_files': [], 'idx_to_' + mode + '_bbox_embed': [],
+                  'idx_to_' + mode + '_objects': []})
+    errors, emb_size = [], None
+
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.imap(pack_sample, tasks, chunksize=8)
+        for task, result in tqdm(zip(tasks, results), total=len(tasks)):
+            mode, key = task[0], task[4]
+            if 'error' not in result and emb_size not in (None, result['emb_size']):
+                result = {'name': result['name'], 'error': 'embed size {} differs from {}'.format(
+                    result['emb_size'], emb_size)}
+            if 'error' in result:
+                if strict:
+                    raise ValueError('Invalid {} sample {}: {}'.format(mode, result['name'], result['error']))
+                errors.append((mode, result['name'], result['error']))
+                continue
+
+            emb_size = result['emb_size']
+            d['idx_to_' + mode + '_files'].append(task[3])
+            d['idx_to_' + mode + '_bbox_embed'].append(key)
+            d['idx_to_' + mode + '_objects'].append(result['objects'])
+            d['checksums'].update(result['checksums'])
+
+    temp = os.path.join(output, 'data.json.tmp')
+    with open(temp, 'w') as f:
+        json.dump(d, f)
+    os.replace(temp, os.path.join(output, 'data.json'))
+    return d, errors
+
+
+def verify_dataset(path, workers=None):
+    '''
+    Return: Relative paths of the files of a packed dataset that are missing or differ from their checksum
+    '''
+    with open(os.path.join(path, 'data.json')) as f:
+        checksums = json.load(f)['checksums']
+    files = sorted(checksums)
+
+    with multiprocessing.Pool(workers) as pool:
+        paths = [os.path.join(path, name) for name in files]
+        existing = [name for name in paths if os.path.exists(name)]
+        digests = dict(zip(existing, tqdm(pool.imap(checksum, existing, chunksize=16), total=len(existing))))
+    return [name for name, full in zip(files, paths) if digests.get(full) != checksums[name]]
+
+
+def main():
+    from args import Arg_train
+
+    parser = argparse.ArgumentParser(description='Validate a raw dataset and pack it at the training resolution')
+    parser.add_argument('--input', help='raw dataset, a dataset with data.json or train and test directories')
+    parser.add_argument('--output', required=True, help='directory of the packed dataset')
+    parser.add_argument('--workers', type=int, default=None, help='processes, defaults to the number of cores')
+    parser.add_argument('--image_format', default='png', choices=['png', 'jpg'])
+    parser.add_argument('--strict', action='store_true', help='stop at the first invalid sample')
+    parser.add_argument('--verify', action='store_true', help='only check the checksums of an existing output')
+    opts = parser.parse_args()
+
+    if opts.verify:
+        mismatches = verify_dataset(opts.output, opts.workers)
+        for name in mismatches:
+            print('Checksum mismatch: {}'.format(name))
+        print('{} files differ from data.json'.format(len(mismatches)))
+        return
+    if opts.input is None:
+        parser.error('--input is required unless --verify is given')
+
+    args = Arg_train()
+    d, errors = pack_dataset(opts.input, opts.output, args.image_size, args.source_size, opts.workers,
+                             opts.image_format, opts.strict)
+    for mode, name, error in errors:
+        print('Skipped {} sample {}: {}'.format(mode, name, error))
+    print('Packed {} train and {} test samples into {}, skipped {}'.format(
+        len(d['idx_to_train_files']), len(d['idx_to_test_files']), opts.output, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import queue
+import threading
+
+import torch
+
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class Prefetcher(object):
+    '''
+    Description: Iterates over the batches of a DataLoader already moved to the device, the next batch being
+                 prepared while the current step runs. On CUDA its non-blocking copies are issued on a side
+                 stream, elsewhere a background thread collates and moves the upcoming batches
+    Params:
+        - loader: DataLoader yielding sample dictionaries, as built by Loader
+        - device: Device receiving every tensor of a batch
+        - normalize: Optional transform applied to the batched images once they are on the device, used when
+                     the dataset leaves its images unnormalized
+        - augment: Optional BatchAugment applied to every batch once it is on the device, before normalize
+        - depth: Number of batches prepared ahead of the current one by the background thread
+    '''
+
+    def __init__(self, loader, device, normalize=None, augment=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.normalize = normalize
+        self.augment = augment
+        self.depth = depth
+
+    def prepare(self, batch, non_blocking=False):
+        batch = {key: value.to(self.device, non_blocking=non_blocking) if torch.is_tensor(value) else value
+                 for key, value in batch.items()}
+        if self.augment is not None:
+            batch = self.augment(batch)
+        if self.normalize is not None:
+            batch['image'] = self.normalize(batch['image'])
+        return batch
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self.stream_batches()
+        return self.thread_batches()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stream_batches(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+
+        def load():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.prepare(batch, non_blocking=True)
+
+        upcoming = load()
+        while upcoming is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = upcoming
+            # the tensors were allocated on the side stream but are consumed on the current one
+            for value in batch.values():
+                if torch.is_tensor(value) and value.device.type == 'cuda':
+                    value.record_stream(current_stream)
+            upcoming = load()
+            yield batch
+
+    def thread_batches(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work():
+            try:
+                for batch in self.loader:
+                    if not put(self.prepare(batch)):
+                        return
+            except Exception as error:
+                put(_Failure(error))
+                return
+            put(_END)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            thread.join()
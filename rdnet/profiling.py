@@ -0,0 +1,236 @@
+import time
+from contextlib import contextmanager
+from functools import partial
+
+import torch
+from torch import nn
+from torch.utils.flop_counter import FlopCounterMode
+
+
+# submodules of RDNet timed through forward hooks, in execution order
+MODEL_STAGES = ('to_patch', 'knowledge', 'dense.scratch', 'dense.reassemble', 'dense.refine', 'head')
+
+
+def reset_peak_rss():
+    '''
+    Return: True when the peak resident set size of the process was reset, which needs Linux 4.0 or later
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    '''
+    Return: Peak resident set size of the process in bytes since the last reset_peak_rss, None outside of Linux
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class StageProfiler(object):
+    '''
+    Description: Measures every stage of a training step, the model stages through forward hooks and the
+                 others through stage(), recording wall time, peak memory and FLOPs every freq steps. On CUDA
+                 the stages are timed with events so that the step is only synchronized once at its end, and the
+                 peak memory is the one allocated by torch on the device. On the CPU it is the peak resident set
+                 size of the whole process, which only Linux can reset between stages, and it does not grow while
+                 torch reuses memory it already holds
+    Params:
+        - model: RDNet, possibly wrapped by DistributedDataParallel or by a DataParallel over a single device,
+                 the stages of the replicas of a DataParallel over several devices run in their own threads and
+                 cannot be told apart
+        - device: Device the model runs on
+        - freq: Number of steps between two profiled steps, 0 disables the measurements
+        - trace_dir: Directory receiving a torch.profiler trace of a few steps, empty to disable it
+    '''
+
+    def __init__(self, model, device, freq=0, trace_dir=''):
+        self.device = torch.device(device)
+        self.freq = freq
+        self.active = False
+        self.data_time = 0.
+        self.records = {}
+        self.open_stages = {}
+        self.flop_counter = None
+        self.track_rss = self.device.type != 'cuda' and reset_peak_rss()
+        # start and end of every step since the last busy_time, recorded without synchronizing
+        self.step_clock = None
+        self.step_clocks = []
+
+        if (freq > 0 or trace_dir != '') and isinstance(model, nn.DataParallel) and len(model.device_ids) > 1:
+            raise ValueError('StageProfiler cannot profile a DataParallel over {} devices, use distributed '
+                             'training or a single device'.format(len(model.device_ids)))
+        model = getattr(model, 'module', model)
+        self.handles = []
+        for name in MODEL_STAGES:
+            module = model.get_submodule(name)
+            self.handles.append(module.register_forward_pre_hook(partial(self.hook_start, name)))
+            self.handles.append(module.register_forward_hook(partial(self.hook_end, name)))
+
+        self.trace = None
+        if trace_dir != '':
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True,
+                profile_memory=True)
+            self.trace.start()
+
+    def timed(self, batches):
+        '''
+        Description: Wraps the iterator over batches to measure how long each step waited for its batch
+        '''
+        batches = iter(batches)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.data_time = time.perf_counter() - start
+            yield batch
+
+    def clock(self):
+        if self.device.type == 'cuda':
+            clock = torch.cuda.Event(enable_timing=True)
+            clock.record()
+            return clock
+        return time.perf_counter()
+
+    def busy_time(self):
+        '''
+        Description: Synchronizes with the device once and sums the time spent between start_step and end_step
+                     by the steps closed since the previous call, measured like the stages
+        Return: Number of seconds and number of steps
+        '''
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            total = sum(start.elapsed_time(end) for start, end in self.step_clocks) / 1e3
+        else:
+            total = sum(end - start for start, end in self.step_clocks)
+        steps = len(self.step_clocks)
+        self.step_clocks = []
+        return total, steps
+
+    def start_step(self, step):
+        self.step_clock = self.clock()
+        self.active = self.freq > 0 and step % self.freq == 0
+        if not self.active:
+            return
+
+        self.records = {}
+        self.flop_counter = FlopCounterMode(display=False)
+        self.flop_counter.__enter__()
+
+    def hook_start(self, name, *unused):
+        self.start(name)
+
+    def hook_end(self, name, *unused):
+        self.end(name)
+
+    def start(self, name):
+        if not self.active and self.trace is None:
+            return
+
+        label = None
+        if self.trace is not None:
+            label = torch.profiler.record_function(name)
+            label.__enter__()
+
+        if not self.active:
+            self.open_stages[name] = (label,)
+            return
+
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif self.track_rss:
+            reset_peak_rss()
+        clock = self.clock()
+        self.open_stages[name] = (label, clock, self.flop_counter.get_total_flops())
+
+    def end(self, name):
+        opened = self.open_stages.pop(name, None)
+        if opened is None:
+            return
+        if opened[0] is not None:
+            opened[0].__exit__(None, None, None)
+        if len(opened) == 1:
+            return
+
+        _, clock, flops = opened
+        if self.device.type == 'cuda':
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            clock = (clock, end)
+            memory = torch.cuda.max_memory_allocated(self.device)
+        else:
+            clock = time.perf_counter() - clock
+            memory = peak_rss() if self.track_rss else None
+        self.records[name] = {'clock': clock, 'memory': memory,
+                              'flops': self.flop_counter.get_total_flops() - flops}
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def end_step(self, writer=None, global_step=0):
+        '''
+        Description: Closes the current step, when it was profiled its measurements are printed and written
+                     to writer under profile/
+        Return: Dictionary of the measurements by stage, empty when the step was not profiled
+        '''
+        if self.step_clock is not None:
+            self.step_clocks.append((self.step_clock, self.clock()))
+            self.step_clock = None
+        if self.trace is not None:
+            self.trace.step()
+        if not self.active:
+            return {}
+
+        self.active = False
+        self.flop_counter.__exit__(None, None, None)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+        results = {'data': {'time_ms': self.data_time * 1e3}}
+        for name, record in self.records.items():
+            clock = record['clock']
+            elapsed = clock[0].elapsed_time(clock[1]) if isinstance(clock, tuple) else clock * 1e3
+            results[name] = {'time_ms': elapsed, 'gflops': record['flops'] / 1e9}
+            if record['memory'] is not None:
+                results[name]['memory_mb'] = record['memory'] / 2 ** 20
+
+        print('Profile step {}: '.format(global_step) + ' | '.join(
+            '{} {:.1f}ms'.format(name, result['time_ms']) for name, result in results.items()))
+        if writer is not None:
+            for name, result in results.items():
+                for key, value in result.items():
+                    writer.add_scalar('profile/{}/{}'.format(key, name), value, global_step)
+
+        return results
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
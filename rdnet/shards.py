@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from dataloader import DataLoadPreprocess, build_sample
+from geometry import Geometry
+
+
+INDEX_FILE = 'index.json'
+SHARD_FIELDS = {
+    'images': np.uint8,
+    'depths': np.uint16,
+    'boxes': np.int32,
+    'embeds': np.float32,
+}
+
+
+def shard_dir(shard_path, mode):
+    if mode == 'online_eval':
+        mode = 'test'
+    return os.path.join(shard_path, mode)
+
+
+def close_shard(shard, files, digests):
+    # the checksums make index.json differ whenever the content of the shards does
+    for f in files.values():
+        f.close()
+    shard['checksums'] = {field: digest.hexdigest() for field, digest in digests.items()}
+
+
+def pack_shards(args, mode, output, shard_size=1024):
+    '''
+    Description: Decodes, resizes and converts every sample of DataLoadPreprocess once and writes the results
+                 into fixed-layout binary shards that ShardedDataset reads back through np.memmap
+    Params:
+        - args: Arg_train instance, data_path and image_size select the source dataset and target resolution
+        - mode: One of train, test or online_eval, test and online_eval both pack the test split
+        - output: Root directory of the shards, a sub-directory per split is created inside
+        - shard_size: Maximum number of samples written into a single shard
+    '''
+    dataset = DataLoadPreprocess(args, mode)
+    size = dataset.geometry.size
+    out_dir = shard_dir(output, mode)
+    os.makedirs(out_dir, exist_ok=True)
+
+    index = {
+        'mode': mode,
+        'image_shape': [args.image_height, args.image_width, 3],
+        'depth_shape': [args.image_height, args.image_width],
+        'emb_size': None,
+        'shards': [],
+        'samples': [],
+    }
+    files, digests = None, None
+    # samples without any object carry no embedding size, the declared size of the store is checked instead
+    emb_size = dataset.embed_store.emb_size if dataset.embed_store is not None else None
+
+    for idx in tqdm(range(len(dataset))):
+        if idx % shard_size == 0:
+            if files is not None:
+                close_shard(index['shards'][-1], files, digests)
+            shard = {'num_samples': 0, 'num_objects': 0}
+            files, digests = {}, {}
+            for field in SHARD_FIELDS:
+                shard[field] = 'shard-{:05d}.{}'.format(len(index['shards']), field)
+                files[field] = open(os.path.join(out_dir, shard[field]), 'wb')
+                digests[field] = hashlib.sha1()
+            index['shards'].append(shard)
+
+        sample_path = dataset.filenames[idx]
+        image = dataset.load_image(sample_path, size)
+        bbox, embedding = dataset.load_bbox_embed(dataset.idx_to_bbox_embed[idx])
+        bbox = np.asarray(bbox, dtype=np.int32)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if len(embedding) > 0:
+            if emb_size in (None, 0):
+                emb_size = embedding.shape[1]
+            elif embedding.shape[1] != emb_size:
+                raise ValueError('Embeddings of {} have size {}, expected {}'.format(
+                    sample_path, embedding.shape[1], emb_size))
+
+        # test and online_eval share the same shards, so depths are packed whenever they exist
+        has_depth = False
+        try:
+            depth_gt = dataset.load_depth(sample_path, size)
+            has_depth = True
+        except IOError:
+            if mode == 'train':
+                raise
+            depth_gt = np.zeros(index['depth_shape'], dtype=np.uint16)
+
+        for field, data in (('images', np.ascontiguousarray(image, dtype=np.uint8)),
+                            ('depths', np.ascontiguousarray(depth_gt, dtype=np.uint16)),
+                            ('boxes', bbox), ('embeds', embedding)):
+            data = data.tobytes()
+            files[field].write(data)
+            digests[field].update(data)
+
+        index['samples'].append([len(index['shards']) - 1, shard['num_samples'],
+                                 shard['num_objects'], len(bbox), has_depth])
+        shard['num_samples'] += 1
+        shard['num_objects'] += len(bbox)
+
+    if files is not None:
+        close_shard(index['shards'][-1], files, digests)
+
+    # a split without any object falls back to the configured size
+    index['emb_size'] = emb_size or args.emb_size
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class ShardedDataset(Dataset):
+    '''
+    Description: Drop-in replacement of DataLoadPreprocess reading samples packed by pack_shards, images, depths,
+                 boxes and embeddings are served straight from memory-mapped shards without any decoding or resizing
+    Params:
+        - args: Arg_train instance, shard_path points to the root given to pack_shards
+        - mode: One of train, test or online_eval
+        - transform: Transform applied to each sample dictionary, same as for DataLoadPreprocess
+    '''
+
+    def __init__(self, args, mode, transform=None):
+        self.args = args
+        self.mode = mode
+        self.transform = transform
+        self.shard_path = shard_dir(args.shard_path, mode)
+
+        with open(os.path.join(self.shard_path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+        if self.index['image_shape'][:2] != [args.image_height, args.image_width]:
+            raise ValueError('Shards in {} were packed at {}, expected {}'.format(
+                self.shard_path, self.index['image_shape'][:2], args.image_size))
+
+        self.crop = Geometry(args.image_size, args.source_size).crop()
+        self.samples = self.index['samples']
+        # memmaps are opened lazily so that each DataLoader worker owns its own file handles
+        self.shards = None
+
+    def open_shards(self):
+        image_shape = tuple(self.index['image_shape'])
+        depth_shape = tuple(self.index['depth_shape'])
+        emb_size = self.index['emb_size']
+        shards = []
+
+        for shard in self.index['shards']:
+            n = shard['num_samples']
+            m = shard['num_objects']
+            shards.append({
+                'images': self.memmap(shard['images'], SHARD_FIELDS['images'], (n,) + image_shape),
+                'depths': self.memmap(shard['depths'], SHARD_FIELDS['depths'], (n,) + depth_shape),
+                'boxes': self.memmap(shard['boxes'], SHARD_FIELDS['boxes'], (m, 4)),
+                'embeds': self.memmap(shard['embeds'], SHARD_FIELDS['embeds'], (m, emb_size)),
+            })
+
+        return shards
+
+    def memmap(self, filename, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.shard_path, filename), dtype=dtype, mode='r', shape=shape)
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self.shards = self.open_shards()
+
+        shard_idx, row, obj_start, obj_count, has_depth = self.samples[idx]
+        shard = self.shards[shard_idx]
+
+        image = shard['images'][row]
+        bbox = shard['boxes'][obj_start:obj_start + obj_count]
+        embedding = shard['embeds'][obj_start:obj_start + obj_count]
+        depth_gt = shard['depths'][row] if has_depth and self.mode != 'test' else None
+
+        return build_sample(self.mode, image, depth_gt, bbox, embedding, self.transform, self.crop)
+
+    def object_counts(self):
+        return [sample[3] for sample in self.samples]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def main():
+    from args import Arg_train
+
+    parser = argparse.ArgumentParser(description='Pack a dataset split into memory-mapped training shards')
+    parser.add_argument('--mode', default='train', choices=['train', 'test', 'online_eval'])
+    parser.add_argument('--output', required=True, help='root directory of the packed shards')
+    parser.add_argument('--shard_size', type=int, default=1024, help='number of samples per shard')
+    opts = parser.parse_args()
+
+    args = Arg_train()
+    index = pack_shards(args, opts.mode, opts.output, opts.shard_size)
+    print('Packed {} samples into {} shards at {}'.format(
+        len(index['samples']), len(index['shards']), shard_dir(opts.output, opts.mode)))
+
+
+if __name__ == '__main__':
+    main()
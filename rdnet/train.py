@@ -19,6 +19,7 @@ import argparse
 import datetime
 import sys
 import os
+import re
 
 import torch
 import torch.nn as nn
@@ -37,13 +38,18 @@ import matplotlib.cm
 import threading
 from tqdm import tqdm
 
-from model import RDNet
-from eval import compute_errors, compute_loss, silog_loss
-from dataloader import Loader
+from model import build_model
+from eval import DepthMetrics, compute_loss, silog_loss
+from dataloader import Loader, normalization, normalize_on_device
+from prefetch import Prefetcher
+from profiling import StageProfiler
+from checkpoint import CheckpointManager, rng_state, seed_rng, set_rng_state
+from geometry import Geometry
 from args import Arg_train
+from debug import NumericsError, check_nonzero, set_check_numerics
 
 
-DEVICE = torch.device('cuda')
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 args = Arg_train()
 
@@ -52,6 +58,7 @@ inv_normalize = transforms.Normalize(
     std=[1/0.229, 1/0.224, 1/0.225]
 )
 silog_criterion = silog_loss(variance_focus=args.variance_focus, num_scale=args.num_scale)
+amp_dtype = getattr(torch, args.amp_dtype)
 
 num_metrics = 10
 low_num = 7
@@ -108,90 +115,130 @@ def normalize_result(value, vmin=None, vmax=None):
     return np.expand_dims(value, 0)
 
 def standardize(depth_map):
-    depth_map[depth_map < args.min_depth_eval] = args.min_depth_eval
-    depth_map[depth_map > args.max_depth_eval] = args.max_depth_eval
-    depth_map[np.isinf(depth_map)] = args.max_depth_eval
-    depth_map[np.isnan(depth_map)] = args.min_depth_eval
-    return depth_map
+    depth_map = torch.nan_to_num(depth_map, nan=args.min_depth_eval,
+                                 posinf=args.max_depth_eval, neginf=args.min_depth_eval)
+    return depth_map.clamp(args.min_depth_eval, args.max_depth_eval)
+
+
+def autocast():
+    return torch.autocast(device_type=DEVICE.type, dtype=amp_dtype, enabled=args.amp)
+
+
+def batches(loader):
+    '''
+    Description: Iterates over the batches of a Loader moved to DEVICE, prefetched one step ahead unless
+                 prefetch is disabled
+    '''
+    normalize = normalization() if normalize_on_device(args) else None
+    prefetcher = Prefetcher(loader.data, DEVICE, normalize=normalize, augment=loader.augment)
+    if args.prefetch:
+        return prefetcher
+    return (prefetcher.prepare(batch) for batch in loader.data)
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
 
 def online_eval(model, dataloader_eval, gpu, ngpus):
-    eval_measures = np.zeros(num_metrics + 1)
-    for _, eval_sample_batched in enumerate(tqdm(dataloader_eval.data)):
+    metrics = DepthMetrics(median=args.eval_median, min_depth=args.min_depth_eval,
+                           max_depth=args.max_depth_eval, device=DEVICE)
+    for _, eval_sample_batched in enumerate(tqdm(batches(dataloader_eval), disable=not is_main_process())):
         with torch.no_grad():
-            image = eval_sample_batched['image'].to(DEVICE)
-            gt_depth = eval_sample_batched['depth'].to(DEVICE)
-            embedding = eval_sample_batched['embedding'].to(DEVICE)
-            location = eval_sample_batched['bbox'].to(DEVICE)
-            mask = eval_sample_batched['mask'].to(DEVICE)
-
-            disp_est = model(image, embedding, location).detach()
+            image = eval_sample_batched['image']
+            gt_depth = eval_sample_batched['depth']
+            embedding = eval_sample_batched['embedding']
+            location = eval_sample_batched['bbox']
+            mask = eval_sample_batched['mask']
+            objects = eval_sample_batched['objects']
+
+            with autocast():
+                disp_est = model(image, embedding, location, objects).detach()
             disp_gt = 1. / gt_depth
             # loss = compute_loss(pred_depth, gt_depth, mask, eps=args.eps,
             #                     trimmed=args.trimmed, num_scale=args.num_scale, alpha=args.alpha)
-            loss = silog_criterion(disp_est, disp_gt, mask).cpu().numpy()
-            gt_depth = gt_depth.cpu().numpy()
-            depth_est = 1. / disp_est.cpu().numpy()
-            pred_depth = standardize(depth_est)
-
-        valid_mask = np.logical_and(
-            gt_depth > args.min_depth_eval, gt_depth < args.max_depth_eval)
-        
-        if args.eigen_crop or args.garg_crop:
-            b, _, gt_height, gt_width = gt_depth.shape
-            eval_mask = np.zeros(valid_mask.shape)
-            '''
-            if args.garg_crop:
-                eval_mask[int(0.40810811 * gt_height):int(0.99189189 * gt_height),
-                          int(0.03594771 * gt_width):int(0.96405229 * gt_width)] = 1
-            elif args.eigen_crop:
-            '''
-            eval_mask[:, :, 45:471, 41:601] = 1
-
-            valid_mask = np.logical_and(valid_mask, eval_mask)
-
-        measures = compute_errors(gt_depth, pred_depth, valid_mask)
-        try:
-            eval_measures[:-1] += np.insert(measures, 0, loss, axis=0)
-        except:
-            print(measures.shape)
-            assert False
-        eval_measures[-1] += 1
-
-    cnt = int(eval_measures[-1])
-    eval_measures /= cnt
+            loss = silog_criterion(disp_est, disp_gt, mask)
+            pred_depth = standardize(1. / disp_est)
+
+            valid_mask = (gt_depth > args.min_depth_eval) & (gt_depth < args.max_depth_eval)
+
+            if args.eigen_crop or args.garg_crop:
+                b, _, gt_height, gt_width = gt_depth.shape
+                eval_mask = torch.zeros_like(valid_mask)
+                '''
+                if args.garg_crop:
+                    eval_mask[int(0.40810811 * gt_height):int(0.99189189 * gt_height),
+                              int(0.03594771 * gt_width):int(0.96405229 * gt_width)] = 1
+                elif args.eigen_crop:
+                '''
+                top, bottom, left, right = Geometry((gt_height, gt_width)).crop()
+                eval_mask[:, :, top:bottom, left:right] = 1
+
+                valid_mask = valid_mask & eval_mask
+
+            metrics.update(gt_depth, pred_depth, valid_mask, loss)
+
+    # every process evaluated its own shard of the test split
+    metrics.all_reduce()
+    cnt = metrics.count
+    eval_measures = metrics.compute()
+    if not is_main_process():
+        return eval_measures
+
     print('Computing errors for {} eval samples'.format(cnt))
     print("{:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}".format(
         'loss', 'silog', 'abs_rel', 'log10', 'rms', 'sq_rel', 'log_rms', 'd1', 'd2', 'd3'))
 
     for i in range(num_metrics - 1):
         print('{:7.3f}, '.format(eval_measures[i]), end='')
-    print('{:7.3f}'.format(eval_measures[-2]))
+    print('{:7.3f}'.format(eval_measures[-1]))
 
     return eval_measures
 
 
+def run_worker(gpu, ngpus_per_node, args):
+    '''
+    Description: Runs main_worker and tears the process group down when a numerics check fails on this process,
+                 so that the collectives the other ranks wait in fail instead of waiting for their timeout
+    '''
+    try:
+        return main_worker(gpu, ngpus_per_node, args)
+    except NumericsError:
+        if args.distributed and dist.is_initialized():
+            dist.destroy_process_group()
+        raise
+
+
 def main_worker(gpu, ngpus_per_node, args):
+    global DEVICE
     args.gpu = gpu
 
+    if args.distributed:
+        args.rank = int(os.environ.get('RANK', gpu))
+        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
+                                world_size=args.world_size, rank=args.rank)
+        if torch.cuda.is_available():
+            DEVICE = torch.device('cuda', gpu)
+            torch.cuda.set_device(DEVICE)
+        # batch_size and num_threads of train_arg.txt are shared by the processes of a node
+        if args.batch_size < ngpus_per_node:
+            raise ValueError('batch_size {} is shared by {} processes per node and must be at least as large'.format(
+                args.batch_size, ngpus_per_node))
+        args.batch_size = int(args.batch_size / ngpus_per_node)
+        args.num_threads = int((args.num_threads + ngpus_per_node - 1) / ngpus_per_node)
+        args.local_world_size = ngpus_per_node
+
+    is_main = not args.distributed or args.rank == 0
+
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
 
+    set_check_numerics(args.check_numerics)
+    if args.check_numerics:
+        print("Numerics checks enabled, every check synchronizes with the device")
+
     # Create model
-    model = RDNet(image_size=args.image_size,
-                  patch_size=args.patch_size,
-                  knowledge_dims=args.knowledge_dims,
-                  dense_dims=args.dense_dims,
-                  latent_dim=args.latent_dims,
-                  data_path=args.data_path,
-                  emb_size=args.emb_size,
-                  use_readout=args.use_readout,
-                  hooks=args.hooks,
-                  activation=args.activation,
-                  landmarks=args.landmarks,
-                  scale=args.scale,
-                  shift=args.shift,
-                  invert=args.invert,
-                  transformer=args.transformer)
+    model = build_model(args)
     model.train()
     num_params = sum([np.prod(p.size()) for p in model.parameters()])
     print("Total number of parameters: {}".format(num_params))
@@ -200,8 +247,14 @@ def main_worker(gpu, ngpus_per_node, args):
                              for p in model.parameters() if p.requires_grad])
     print("Total number of learning parameters: {}".format(num_params_update))
 
-    model = torch.nn.DataParallel(model)
-    model.to(DEVICE)
+    if args.distributed:
+        model.to(DEVICE)
+        # the first fusion block of RefineBlock never uses its resConfUnit1
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[gpu] if DEVICE.type == 'cuda' else None, find_unused_parameters=True)
+    else:
+        model = torch.nn.DataParallel(model)
+        model.to(DEVICE)
 
     print("Model Initialized")
 
@@ -210,45 +263,16 @@ def main_worker(gpu, ngpus_per_node, args):
     best_eval_measures_higher_better = torch.zeros(num_metrics - low_num).cpu()
     best_eval_steps = np.zeros(num_metrics, dtype=np.int32)
 
-    model_just_loaded = False
-    if args.checkpoint_path != '':
-        if os.path.isfile(args.checkpoint_path):
-            print("Loading checkpoint '{}'".format(args.checkpoint_path))
-            if args.gpu is None:
-                checkpoint = torch.load(args.checkpoint_path)
-            else:
-                loc = 'cuda:{}'.format(args.gpu)
-                checkpoint = torch.load(args.checkpoint_path, map_location=loc)
-            global_step = checkpoint['global_step']
-            model.load_state_dict(checkpoint['model'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            try:
-                best_eval_measures_higher_better = checkpoint['best_eval_measures_higher_better'].cpu(
-                )
-                best_eval_measures_lower_better = checkpoint['best_eval_measures_lower_better'].cpu(
-                )
-                best_eval_steps = checkpoint['best_eval_steps']
-            except KeyError:
-                print("Could not load values for online evaluation")
-
-            print("Loaded checkpoint '{}' (global_step {})".format(
-                args.checkpoint_path, checkpoint['global_step']))
-        else:
-            print("No checkpoint found at '{}'".format(args.checkpoint_path))
-        model_just_loaded = True
-
-    if args.retrain:
-        global_step = 0
-
     cudnn.benchmark = True
 
     dataloader = Loader(args, 'train')
     dataloader_eval = Loader(args, 'online_eval')
 
     # Logging
-    writer = SummaryWriter(args.log_directory + '/' +
-                           args.model_name + '/summaries', flush_secs=30)
-    if args.do_online_eval:
+    if is_main:
+        writer = SummaryWriter(args.log_directory + '/' +
+                               args.model_name + '/summaries', flush_secs=30)
+    if args.do_online_eval and is_main:
         if args.eval_summary_directory != '':
             eval_summary_path = os.path.join(
                 args.eval_summary_directory, args.model_name)
@@ -257,22 +281,15 @@ def main_worker(gpu, ngpus_per_node, args):
         eval_summary_writer = SummaryWriter(eval_summary_path, flush_secs=30)
 
     start_time = time.time()
-    duration = 0
 
     num_log_images = args.batch_size
     end_learning_rate = args.end_learning_rate if args.end_learning_rate != - \
         1 else 0.1 * args.learning_rate
 
-    var_sum = [var.sum() for var in model.parameters() if var.requires_grad]
-    var_cnt = len(var_sum)
-    var_sum = np.sum(var_sum)
-
-    print("Initial variables' sum: {:.3f}, avg: {:.3f}".format(
-        var_sum, var_sum/var_cnt))
-
     steps_per_epoch = len(dataloader.data)
     num_total_steps = args.num_epochs * steps_per_epoch
-    epoch = global_step // steps_per_epoch
+    epoch = 0
+    start_step = 0
 
     # Training parameters
     if args.optim == 'adam':
@@ -285,56 +302,164 @@ def main_worker(gpu, ngpus_per_node, args):
         scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.learning_rate, total_steps=num_total_steps)
     elif args.schedule == 'plateau':
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=args.patience, # threshold_mode='abs',
-                                                               threshold=args.thresh, verbose=True)
+                                                               threshold=args.thresh)
+
+    # bfloat16 has the exponent range of fp32, only float16 gradients need to be scaled
+    scaler = torch.amp.GradScaler(DEVICE.type, enabled=args.amp and amp_dtype == torch.float16)
+    if args.amp:
+        print("Mixed precision training in {}".format(args.amp_dtype))
+
+    # restored once every object holding training state exists
+    model_just_loaded = False
+    checkpoint_path = args.checkpoint_path
+    if checkpoint_path == 'latest':
+        checkpoint_path = os.path.join(args.log_directory, args.model_name, 'model-latest')
+    if checkpoint_path != '':
+        if os.path.isfile(checkpoint_path):
+            print("Loading checkpoint '{}'".format(checkpoint_path))
+            if args.retrain:
+                checkpoint = CheckpointManager.restore(checkpoint_path, model)
+            else:
+                checkpoint = CheckpointManager.restore(checkpoint_path, model, optimizer, scheduler, scaler)
+                global_step = checkpoint['global_step']
+                if 'epoch_step' in checkpoint:
+                    # saved at the end of a step, training goes on with the next batch of the same epoch
+                    global_step += 1
+                    epoch, start_step = checkpoint['epoch'], checkpoint['epoch_step']
+                    if start_step >= steps_per_epoch:
+                        epoch, start_step = epoch + 1, 0
+                    set_rng_state(checkpoint['rng'])
+                    if args.distributed and args.rank != 0:
+                        # only rank 0 saves its generators, the other ranks derive their own streams again
+                        seed_rng(hash((args.seed, args.rank, global_step)) & (2 ** 63 - 1))
+                else:
+                    epoch = global_step // steps_per_epoch
+                if args.schedule == 'cycle' and scheduler.total_steps != num_total_steps:
+                    # the restored schedule keeps the total_steps of the interrupted run, it is stretched to the
+                    # num_epochs and dataset of this one from the step it reached
+                    if scheduler.last_epoch > num_total_steps:
+                        raise ValueError('The checkpoint went through {} steps of its schedule, more than the {} steps '
+                                         'of num_epochs {}'.format(scheduler.last_epoch, num_total_steps,
+                                                                   args.num_epochs))
+                    print('Resuming the schedule of {} steps over {} steps'.format(scheduler.total_steps,
+                                                                                  num_total_steps))
+                    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.learning_rate,
+                                                                    total_steps=num_total_steps,
+                                                                    last_epoch=scheduler.last_epoch - 1)
+            try:
+                best_eval_measures_higher_better = checkpoint['best_eval_measures_higher_better'].cpu(
+                )
+                best_eval_measures_lower_better = checkpoint['best_eval_measures_lower_better'].cpu(
+                )
+                best_eval_steps = checkpoint['best_eval_steps']
+            except KeyError:
+                print("Could not load values for online evaluation")
+
+            print("Loaded checkpoint '{}' (global_step {}, epoch {}, step {})".format(
+                checkpoint_path, checkpoint['global_step'], epoch, start_step))
+        else:
+            print("No checkpoint found at '{}'".format(checkpoint_path))
+        model_just_loaded = True
+
+    var_sum = [var.detach().sum() for var in model.parameters() if var.requires_grad]
+    var_cnt = len(var_sum)
+    var_sum = torch.stack(var_sum).sum()
+
+    print("Initial variables' sum: {:.3f}, avg: {:.3f}".format(
+        var_sum, var_sum/var_cnt))
+
+    def training_state(epoch, step):
+        return {'global_step': global_step,
+                'epoch': epoch,
+                'epoch_step': step + 1,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'scaler': scaler.state_dict(),
+                'rng': rng_state(),
+                'best_eval_measures_higher_better': best_eval_measures_higher_better,
+                'best_eval_measures_lower_better': best_eval_measures_lower_better,
+                'best_eval_steps': best_eval_steps}
+
+    profiler = StageProfiler(model, DEVICE, freq=args.profile_freq, trace_dir=args.profile_trace if is_main else '')
+
+    if is_main:
+        # a single best checkpoint per metric, the periodic ones follow keep_checkpoints
+        keep = {'best_' + name: 1 for name in eval_metrics}
+        if args.keep_checkpoints > 0:
+            keep['periodic'] = args.keep_checkpoints
+        # files left by an earlier run or before a restart are retained along the new ones
+        patterns = {'best_' + name: r'model-(\d+)-best_{}_[^_]+'.format(re.escape(name)) for name in eval_metrics}
+        patterns['periodic'] = r'model-(\d+)'
+        checkpoints = CheckpointManager(args.log_directory + '/' + args.model_name, keep=keep,
+                                        async_save=args.async_checkpoint, patterns=patterns)
 
     while epoch < args.num_epochs:
         print(epoch, '/', args.num_epochs)
-        for step, sample_batched in enumerate(dataloader.data):
+        dataloader.set_epoch(epoch, start_step)
+
+        for step, sample_batched in enumerate(profiler.timed(batches(dataloader)), start=start_step):
+            profiler.start_step(global_step)
             optimizer.zero_grad()
-            before_op_time = time.time()
 
-            image = sample_batched['image'].to(DEVICE)
-            depth_gt = sample_batched['depth'].to(DEVICE)
-            embedding = sample_batched['embedding'].to(DEVICE)
-            location = sample_batched['bbox'].to(DEVICE)
-            mask = sample_batched['mask'].to(DEVICE)
+            image = sample_batched['image']
+            depth_gt = sample_batched['depth']
+            embedding = sample_batched['embedding']
+            location = sample_batched['bbox']
+            mask = sample_batched['mask']
+            objects = sample_batched['objects']
 
-            disp_est = model(image, embedding, location)
-            disp_gt = 1. / depth_gt
+            with autocast():
+                disp_est = model(image, embedding, location, objects)
+                disp_gt = 1. / depth_gt
 
-            # computeloss
-            # loss = compute_loss(depth_est, depth_gt, mask, eps=args.eps,
-            #                     trimmed=args.trimmed, num_scale=args.num_scale, alpha=args.alpha)
-            # assert depth_est.min() > 0
-            loss = silog_criterion(disp_est, disp_gt, mask)
+                # computeloss
+                # loss = compute_loss(depth_est, depth_gt, mask, eps=args.eps,
+                #                     trimmed=args.trimmed, num_scale=args.num_scale, alpha=args.alpha)
+                # assert depth_est.min() > 0
+                with profiler.stage('loss'):
+                    loss = silog_criterion(disp_est, disp_gt, mask)
 
-            assert 0 not in loss
-            loss.backward()
+            check_nonzero('silog_loss', loss, 0)
+            with profiler.stage('backward'):
+                scaler.scale(loss).backward()
 
             # for param_group in optimizer.param_groups:
             #     current_lr = (args.learning_rate - end_learning_rate) * \
             #         (1 - global_step / num_total_steps) ** 0.9 + end_learning_rate
             #     param_group['lr'] = current_lr
 
-            optimizer.step()
+            with profiler.stage('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
             if args.schedule == 'cycle':
                 scheduler.step()
+            profiler.end_step(writer if is_main else None, global_step)
 
             print('[epoch][s/s_per_e/gs]: [{}][{}/{}/{}], loss: {:.12f}'.format(
                 epoch, step, steps_per_epoch, global_step, loss))
             # print('Current lr: {:.12f}, {:.12f}'.format(current_lr, args.learning_rate))
-            if np.isnan(loss.cpu().item()):
+            # every rank aborts when one of them sees a non-finite loss, the others would otherwise wait for it in
+            # the all-reduce of the next step
+            nonfinite = (~torch.isfinite(loss.detach())).to(torch.int32)
+            if args.distributed:
+                dist.all_reduce(nonfinite, op=dist.ReduceOp.MAX)
+            if nonfinite.item():
                 print('NaN in loss occurred. Aborting training.')
+                profiler.close()
+                if is_main:
+                    checkpoints.close()
                 return -1
 
-            duration += time.time() - before_op_time
-            if global_step and global_step % args.log_freq == 0 and not model_just_loaded:
-                var_sum = [var.sum()
+            if global_step and global_step % args.log_freq == 0:
+                # step times measured by the profiler on the device, read by every rank so that they do not pile up
+                busy, busy_steps = profiler.busy_time()
+            if is_main and global_step and global_step % args.log_freq == 0 and not model_just_loaded:
+                var_sum = [var.detach().sum()
                            for var in model.parameters() if var.requires_grad]
                 var_cnt = len(var_sum)
-                var_sum = np.sum(var_sum)
-                examples_per_sec = args.batch_size / duration * args.log_freq
-                duration = 0
+                var_sum = torch.stack(var_sum).sum()
+                examples_per_sec = args.batch_size * busy_steps / busy if busy > 0 else 0
                 time_sofar = (time.time() - start_time) / 3600
                 training_time_left = (
                     num_total_steps / global_step - 1.0) * time_sofar
@@ -357,22 +482,16 @@ def main_worker(gpu, ngpus_per_node, args):
                 #         'image/image/{}'.format(i), inv_normalize(image[i, :, :, :]).data, global_step)
                 writer.flush()
 
-            if not args.do_online_eval and global_step and global_step % args.save_freq == 0:
-                checkpoint = {'global_step': global_step,
-                              'model': model.state_dict(),
-                              'optimizer': optimizer.state_dict()}
-                torch.save(checkpoint, args.log_directory + '/' +
-                           args.model_name + '/model-{}'.format(global_step))
-
             if args.do_online_eval and global_step and global_step % args.eval_freq == 0 and not model_just_loaded:
                 model.eval()
                 eval_measures = online_eval(
                     model, dataloader_eval, gpu, ngpus_per_node)
 
-                if eval_measures is not None:
-                    if args.schedule == 'plateau':
-                        scheduler.step(eval_measures[0])
-                    
+                if args.schedule == 'plateau':
+                    scheduler.step(eval_measures[0])
+
+                if is_main:
+                    best_names = []
                     for i in range(len(eval_metrics)):
                         eval_summary_writer.add_scalar(
                             eval_metrics[i], int(global_step))
@@ -390,37 +509,44 @@ def main_worker(gpu, ngpus_per_node, args):
                             best_eval_measures_higher_better[i - low_num] = measure.item()
                             is_best = True
                         if is_best:
-                            old_best_step = best_eval_steps[i]
-                            old_best_name = '/model-{}-best_{}_{:.5f}'.format(
-                                old_best_step, eval_metrics[i], old_best)
-                            model_path = args.log_directory + '/' + args.model_name + old_best_name
-                            if os.path.exists(model_path):
-                                command = 'rm {}'.format(model_path)
-                                os.system(command)
                             best_eval_steps[i] = global_step
-                            model_save_name = '/model-{}-best_{}_{:.5f}'.format(
+                            model_save_name = 'model-{}-best_{}_{:.5f}'.format(
                                 global_step, eval_metrics[i], measure)
-                            print('New best for {}. Saving model: {}'.format(
+                            print('New best for {}. Saving model: /{}'.format(
                                 eval_metrics[i], model_save_name))
-                            checkpoint = {'global_step': global_step,
-                                          'model': model.state_dict(),
-                                          'optimizer': optimizer.state_dict(),
-                                          'best_eval_measures_higher_better': best_eval_measures_higher_better,
-                                          'best_eval_measures_lower_better': best_eval_measures_lower_better,
-                                          'best_eval_steps': best_eval_steps
-                                          }
-                            torch.save(checkpoint, args.log_directory +
-                                       '/' + args.model_name + model_save_name)
+                            best_names.append((model_save_name, 'best_' + eval_metrics[i]))
+
+                    # one file for every metric improved at this step, the previous bests are dropped by retention
+                    if best_names:
+                        checkpoints.save(training_state(epoch, step), best_names)
                     eval_summary_writer.flush()
                 model.train()
                 block_print()
                 enable_print()
 
+            # model-latest is always kept up to date so that a preempted run resumes from it. It is saved after the
+            # online eval of the same step, which a resumed run skips, so that it holds the best measures of that step
+            if is_main and global_step and global_step % args.save_freq == 0:
+                names = [('model-latest', 'latest')]
+                if not args.do_online_eval:
+                    names.insert(0, ('model-{}'.format(global_step), 'periodic'))
+                checkpoints.save(training_state(epoch, step), names)
+
             model_just_loaded = False
             global_step += 1
 
+        start_step = 0
         epoch += 1
 
+    profiler.close()
+    if is_main:
+        checkpoints.close()
+        writer.close()
+        if args.do_online_eval:
+            eval_summary_writer.close()
+    if args.distributed:
+        dist.destroy_process_group()
+
 
 def main():
     if args.mode != 'train':
@@ -446,7 +572,18 @@ def main():
         print("This will evaluate the model every eval_freq {} steps and save best models for individual eval metrics."
               .format(args.eval_freq))
 
-    main_worker(args.gpu, ngpus_per_node, args)
+    if args.distributed and 'LOCAL_RANK' in os.environ:
+        # launched by torchrun, which already started one process per device
+        args.dist_url = 'env://'
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        run_worker(int(os.environ['LOCAL_RANK']), int(os.environ['LOCAL_WORLD_SIZE']), args)
+    elif args.distributed:
+        # one process per GPU, or world_size CPU processes when there is none
+        nprocs = ngpus_per_node if ngpus_per_node > 0 else args.world_size
+        args.world_size = nprocs
+        mp.spawn(run_worker, nprocs=nprocs, args=(nprocs, args))
+    else:
+        run_worker(args.gpu, ngpus_per_node, args)
 
 
 if __name__ == '__main__':